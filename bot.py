@@ -1,16 +1,25 @@
 import asyncio
 import os
 import re
+import sys
+import time
+import signal
+import threading
+import math
 import logging
 import hashlib
 import json
+import html
+import shutil
+from collections import deque
+from dataclasses import dataclass, field, asdict, replace
 from datetime import datetime, timedelta
-from typing import Dict
-from telethon import TelegramClient, events
+from typing import Dict, List, Optional
+from telethon import TelegramClient, events, utils
 from telethon.sessions import StringSession
-from telethon.tl.types import MessageMediaPhoto, MessageMediaDocument
+from telethon.tl.types import MessageMediaPhoto, MessageMediaDocument, PeerChannel
 from aiogram import Bot, Dispatcher, types
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, InputMediaPhoto, InputMediaVideo
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, BufferedInputFile, InputMediaPhoto, InputMediaVideo
 from aiogram.filters import CommandStart, Command
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
@@ -26,7 +35,16 @@ TARGET_CHANNEL = os.getenv("TARGET_CHANNEL")
 SESSION_STRING = os.getenv("SESSION_STRING")
 
 CHANNEL_FOOTER = '\n\n<a href="https://t.me/nsmedia23">NS Media</a>'
-STATS_FILE = "/tmp/bot_stats.json"
+EXTRA_TARGETS = json.loads(os.getenv("EXTRA_TARGETS", "[]"))
+STATS_FILE = os.getenv("STATS_FILE", "/tmp/bot_stats.json")
+SERIES_FILE = os.getenv("SERIES_FILE", "/tmp/bot_series.json")
+SERIES_SAVE_INTERVAL = 300
+STATE_FILE = os.getenv("STATE_FILE", "/tmp/bot_state.json")
+MEDIA_DIR = os.getenv("MEDIA_DIR", "/tmp")
+os.makedirs(MEDIA_DIR, exist_ok=True)
+ENTITIES_FILE = os.getenv("ENTITIES_FILE", "/tmp/bot_entities.json")
+CONFIG_FILE = os.getenv("CONFIG_FILE", "/tmp/bot_config.json")
+RELEVANCE_FILE = os.getenv("RELEVANCE_FILE", "/tmp/bot_relevance.json")
 
 SOURCE_CHANNELS = [
     "media1337",
@@ -53,6 +71,57 @@ AD_KEYWORDS = [
     "нативная"
 ]
 
+@dataclass(slots=True)
+class MediaItem:
+    path: str
+    type: str
+
+
+@dataclass(slots=True)
+class FileRef:
+    file_id: str
+    type: str
+
+
+@dataclass(slots=True)
+class Post:
+    text: str
+    original: str
+    source: str
+    media_path: Optional[str] = None
+    media_type: Optional[str] = None
+    media_group: Optional[List[MediaItem]] = None
+    score: Optional[float] = None
+    rewritten: bool = True
+    file_ids: Optional[List[FileRef]] = None
+    targets: Optional[List[int]] = None
+    preview_id: Optional[int] = None
+    created_at: float = field(default_factory=time.time)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Post":
+        data = dict(data)
+        if data.get("media_group"):
+            data["media_group"] = [MediaItem(**m) for m in data["media_group"]]
+        if data.get("file_ids"):
+            data["file_ids"] = [FileRef(**f) for f in data["file_ids"]]
+        return cls(**data)
+
+
+@dataclass(slots=True)
+class GroupItem:
+    id: int
+    text: str
+    media: object
+    date: datetime
+
+
+@dataclass(slots=True)
+class GroupBuffer:
+    source: str
+    items: List[GroupItem] = field(default_factory=list)
+
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -69,16 +138,128 @@ bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
-pending_posts = {}
+pending_posts: Dict[str, Post] = {}
+MAX_PENDING = 200
+PENDING_TTL = 86400
 recent_hashes = []
 MAX_HASHES = 100
+ad_pattern = None
 scheduled_posts = {}
 edit_state = {}
+published_posts = {}
+MAX_PUBLISHED = 200
+PUBLISH_WORKERS = 3
+publish_all_running = False
 
-media_groups: Dict[int, Dict] = {}
+media_groups: Dict[int, GroupBuffer] = {}
 MEDIA_GROUP_TIMEOUT = 10
 registered_entities = []
 resolved_channel_id = None
+resolved_chats = {}
+resolved_sources: Dict[str, int] = {}
+source_chat_ids = set()
+source_handler_registered = False
+
+CONFIG_POLL_INTERVAL = 10
+config_mtime = None
+
+PUBLISH_TARGETS = [{"chat": TARGET_CHANNEL, "footer": CHANNEL_FOOTER, "delay_minutes": 0}] + [
+    {"chat": t["chat"], "footer": t.get("footer", CHANNEL_FOOTER), "delay_minutes": t.get("delay_minutes", 0)}
+    for t in EXTRA_TARGETS
+]
+CHAT_SEND_INTERVAL = 1.0
+chat_limits: Dict[str, Dict] = {}
+
+PREVIEW_COMPRESS = os.getenv("PREVIEW_COMPRESS", "0") == "1"
+PREVIEW_MIN_BYTES = 200 * 1024
+PREVIEW_MAX_SIDE = 1280
+PREVIEW_VIDEO_HEIGHT = 480
+PREVIEW_TIMEOUT = 60
+FFMPEG_WORKERS = 2
+FFMPEG = shutil.which("ffmpeg")
+ffmpeg_semaphore = asyncio.Semaphore(FFMPEG_WORKERS)
+HASH_WORKERS = 2
+HASH_TIMEOUT = 15
+hash_semaphore = asyncio.Semaphore(HASH_WORKERS)
+
+recent_media_ids = []
+MAX_MEDIA_IDS = 500
+recent_media_hashes = []
+MAX_MEDIA_HASHES = 300
+MEDIA_HASH_DISTANCE = 6
+MEDIA_HASH_MIN_CONTRAST = 12
+MEDIA_HASH_MIN_BITS = 8
+STARTUP_CONCURRENCY = 4
+boot_time = None
+startup_timings = {}
+
+LAZY_REWRITE = os.getenv("LAZY_REWRITE", "0") == "1"
+rewrite_tasks: Dict[str, asyncio.Task] = {}
+deferred_rewrites = set()
+
+LOOP_MONITOR_INTERVAL = 0.5
+LOOP_LAG_WARN = 0.5
+SLOW_CALLBACK_THRESHOLD = 0.1
+loop_lag_samples = deque(maxlen=120)
+loop_lag_max = 0.0
+slow_callbacks = {}
+
+WATCHDOG_INTERVAL = 30
+GAP_MIN = 900
+GAP_FACTOR = 4
+STREAM_GAP = 900
+RECOVER_LIMIT = 20
+RECONNECT_MAX_DELAY = 60
+source_activity: Dict[int, Dict] = {}
+seen_messages = deque(maxlen=1000)
+conn_metrics = {
+    "reconnects": 0,
+    "last_recovery": None,
+    "gaps": 0,
+    "recovered": 0,
+    "catch_ups": 0,
+    "last_update": None
+}
+reconnect_lock = asyncio.Lock()
+
+MAX_POST_TASKS = 8
+SHUTDOWN_TIMEOUT = 30
+post_slots = asyncio.Semaphore(MAX_POST_TASKS)
+shutdown_event = asyncio.Event()
+background_tasks: Dict[str, asyncio.Task] = {}
+task_restarts: Dict[str, int] = {}
+tracked_tasks = set()
+
+PROFILE_INTERVAL = 0.005
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+profiler = {"thread": None, "stop": None, "task": None, "samples": {}, "started": None}
+
+REWRITE_MODEL = "gpt-4.1"
+REWRITE_MAX_TOKENS = 500
+REWRITE_TEMPERATURE = 0.7
+REWRITE_BATCH_WINDOW = 1.5
+REWRITE_BATCH_SIZE = 5
+rewrite_queue = []
+rewrite_batch_task = None
+
+REWRITE_BATCH_API = os.getenv("REWRITE_BATCH_API", "0") == "1"
+BACKFILL_AGE = 600
+BATCH_API_WINDOW = 60
+BATCH_API_POLL = 60
+BATCH_API_TIMEOUT = 3600
+batch_api_queue = []
+batch_api_task = None
+
+RELEVANCE_MIN_SAMPLES = 30
+RELEVANCE_THRESHOLD = float(os.getenv("RELEVANCE_THRESHOLD", "0.3"))
+RELEVANCE_DROP = float(os.getenv("RELEVANCE_DROP", "0"))
+MAX_RELEVANCE_WORDS = 20000
+
+relevance = {
+    "published": {"docs": 0, "total": 0, "words": {}},
+    "skipped": {"docs": 0, "total": 0, "words": {}}
+}
 
 stats = {
     "received": 0,
@@ -92,6 +273,74 @@ stats = {
     "start_time": None
 }
 
+MINUTE_BUCKETS = 60
+HOUR_BUCKETS = 48
+STATS_WINDOWS = {"15m": 15 * 60, "1h": 3600, "6h": 6 * 3600, "24h": 24 * 3600, "48h": 48 * 3600}
+stats_version = 0
+stats_render_cache = {}
+
+
+class RollingCounter:
+    def __init__(self, buckets: int, width: int):
+        self.width = width
+        self.counts = [0] * buckets
+        self.slots = [-1] * buckets
+
+    def add(self, now: float, n: int = 1):
+        slot = int(now // self.width)
+        i = slot % len(self.counts)
+        if self.slots[i] != slot:
+            self.slots[i] = slot
+            self.counts[i] = 0
+        self.counts[i] += n
+
+    def dump(self) -> dict:
+        return {str(s): c for s, c in zip(self.slots, self.counts) if s >= 0 and c}
+
+    def restore(self, data: dict):
+        for s, c in data.items():
+            s = int(s)
+            i = s % len(self.counts)
+            if s > self.slots[i]:
+                self.slots[i] = s
+                self.counts[i] = c
+
+    def total(self, now: float, window: int) -> int:
+        slot = int(now // self.width)
+        buckets = min(len(self.counts), max(1, window // self.width))
+        result = 0
+        for s in range(slot - buckets + 1, slot + 1):
+            i = s % len(self.counts)
+            if self.slots[i] == s:
+                result += self.counts[i]
+        return result
+
+
+class TimeSeries:
+    def __init__(self):
+        self.minutes = RollingCounter(MINUTE_BUCKETS, 60)
+        self.hours = RollingCounter(HOUR_BUCKETS, 3600)
+
+    def add(self, now: float):
+        self.minutes.add(now)
+        self.hours.add(now)
+
+    def dump(self) -> dict:
+        return {"minutes": self.minutes.dump(), "hours": self.hours.dump()}
+
+    def restore(self, data: dict):
+        self.minutes.restore(data.get("minutes", {}))
+        self.hours.restore(data.get("hours", {}))
+
+    def total(self, now: float, window: int) -> int:
+        if window <= MINUTE_BUCKETS * 60:
+            return self.minutes.total(now, window)
+        return self.hours.total(now, window)
+
+
+series: Dict[str, Dict[str, TimeSeries]] = {}
+series_since = None
+
 REWRITE_PROMPT = """Ты — опытный редактор с 20-летним стажем в издательстве. 
 Твоя задача — переписать предоставленный текст так, как это сделал бы живой человек-редактор: сделай его более плавным, естественным, 
 увлекательным и профессиональным.
@@ -116,8 +365,19 @@ REWRITE_PROMPT = """Ты — опытный редактор с 20-летним
 {text}"""
 
 
+REWRITE_BATCH_PROMPT = REWRITE_PROMPT.rsplit("Текст:", 1)[0] + """Ниже несколько независимых текстов в JSON. Перепиши каждый по этим правилам отдельно.
+Верни только JSON вида {{"items": [{{"id": 0, "text": "переписанный текст"}}]}} с теми же id.
+
+Тексты:
+{items}"""
+
+
+def is_backfill(msg) -> bool:
+    return (datetime.now(msg.date.tzinfo) - msg.date).total_seconds() > BACKFILL_AGE
+
+
 def load_stats():
-    global stats
+    global stats, series_since
     try:
         if os.path.exists(STATS_FILE):
             with open(STATS_FILE, 'r') as f:
@@ -125,6 +385,19 @@ def load_stats():
                 stats.update(saved)
     except:
         pass
+    try:
+        if os.path.exists(SERIES_FILE):
+            with open(SERIES_FILE, 'r') as f:
+                saved = json.load(f)
+            series_since = saved.get("since")
+            for key, by_source in saved.get("series", {}).items():
+                for name, data in by_source.items():
+                    ts = series.setdefault(key, {}).setdefault(name, TimeSeries())
+                    ts.restore(data)
+    except:
+        pass
+    if not series_since:
+        series_since = time.time()
     if not stats["start_time"]:
         stats["start_time"] = datetime.now().isoformat()
 
@@ -137,8 +410,47 @@ def save_stats():
         pass
 
 
+def save_series():
+    data = {
+        "since": series_since,
+        "series": {key: {name: ts.dump() for name, ts in by_source.items()} for key, by_source in series.items()}
+    }
+    try:
+        with open(SERIES_FILE, 'w') as f:
+            json.dump(data, f)
+    except Exception as e:
+        logger.error(f"Series save error: {e}")
+
+
+async def series_saver():
+    while True:
+        await asyncio.sleep(SERIES_SAVE_INTERVAL)
+        save_series()
+
+
+def record_series(key: str, source: str = None):
+    now = time.time()
+    by_source = series.setdefault(key, {})
+    for name in ("*", source) if source else ("*",):
+        if name not in by_source:
+            by_source[name] = TimeSeries()
+        by_source[name].add(now)
+
+
+def series_covers(window: int) -> bool:
+    return series_since is not None and time.time() - series_since >= window
+
+
+def series_total(key: str, window: int, source: str = "*") -> int:
+    ts = series.get(key, {}).get(source)
+    return ts.total(time.time(), window) if ts else 0
+
+
 def inc_stat(key: str, source: str = None):
+    global stats_version
     stats[key] = stats.get(key, 0) + 1
+    stats_version += 1
+    record_series(key, source)
     if source:
         if source not in stats["by_source"]:
             stats["by_source"][source] = {"received": 0, "published": 0, "filtered": 0}
@@ -146,11 +458,61 @@ def inc_stat(key: str, source: str = None):
             stats["by_source"][source]["received"] += 1
         elif key == "published":
             stats["by_source"][source]["published"] += 1
-        elif key in ["filtered_ad", "filtered_duplicate", "skipped"]:
+        elif key in ["filtered_ad", "filtered_duplicate", "filtered_score", "skipped"]:
             stats["by_source"][source]["filtered"] += 1
     save_stats()
 
 
+def load_relevance():
+    try:
+        if os.path.exists(RELEVANCE_FILE):
+            with open(RELEVANCE_FILE, 'r') as f:
+                relevance.update(json.load(f))
+    except:
+        pass
+
+
+def save_relevance():
+    try:
+        with open(RELEVANCE_FILE, 'w') as f:
+            json.dump(relevance, f)
+    except:
+        pass
+
+
+def relevance_tokens(text: str, source: str) -> set:
+    tokens = set(re.findall(r'\w{3,}', (text or "").lower()[:4000]))
+    tokens.add(f"@{source}")
+    return tokens
+
+
+def train_relevance(post: Post, label: str):
+    model = relevance[label]
+    model["docs"] += 1
+    for tok in relevance_tokens(post.original, post.source):
+        model["words"][tok] = model["words"].get(tok, 0) + 1
+        model["total"] += 1
+    if len(model["words"]) > MAX_RELEVANCE_WORDS:
+        rare = [tok for tok, c in model["words"].items() if c == 1]
+        for tok in rare:
+            del model["words"][tok]
+        model["total"] -= len(rare)
+    save_relevance()
+
+
+def score_relevance(text: str, source: str):
+    pub, skip = relevance["published"], relevance["skipped"]
+    if pub["docs"] + skip["docs"] < RELEVANCE_MIN_SAMPLES or not pub["docs"] or not skip["docs"]:
+        return None
+    vocab = len(set(pub["words"]) | set(skip["words"])) + 1
+    log_odds = math.log(pub["docs"] / skip["docs"])
+    for tok in relevance_tokens(text, source):
+        log_odds += math.log((pub["words"].get(tok, 0) + 1) / (pub["total"] + vocab))
+        log_odds -= math.log((skip["words"].get(tok, 0) + 1) / (skip["total"] + vocab))
+    log_odds = max(-30.0, min(30.0, log_odds))
+    return 1 / (1 + math.exp(-log_odds))
+
+
 def get_text_hash(text: str) -> str:
     clean = re.sub(r'[^\w\s]', '', text.lower())
     clean = ' '.join(clean.split()[:20])
@@ -169,11 +531,131 @@ def is_duplicate(text: str) -> bool:
     return False
 
 
+def get_media_id(msg):
+    if isinstance(msg.media, MessageMediaPhoto) and msg.media.photo:
+        return msg.media.photo.id
+    if isinstance(msg.media, MessageMediaDocument) and msg.media.document:
+        return msg.media.document.id
+    return None
+
+
+def is_duplicate_media_ids(ids: list) -> bool:
+    ids = [i for i in ids if i]
+    if not ids:
+        return False
+    if all(i in recent_media_ids for i in ids):
+        return True
+    for i in ids:
+        if i not in recent_media_ids:
+            recent_media_ids.append(i)
+    del recent_media_ids[:-MAX_MEDIA_IDS]
+    return False
+
+
+async def compute_dhash(path: str, media_type: str):
+    if not FFMPEG or not path or not os.path.exists(path):
+        return None
+    
+    async def grab(seek: str):
+        args = ["-y", "-v", "error"]
+        if seek:
+            args += ["-ss", seek]
+        args += ["-i", path, "-vf", "scale=9:8:flags=area,format=gray",
+                 "-frames:v", "1", "-f", "rawvideo", "-"]
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG, *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            out, _ = await asyncio.wait_for(proc.communicate(), HASH_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return b""
+        return out
+    
+    async with hash_semaphore:
+        pixels = await grab("1") if media_type in ("video", "gif") else b""
+        if len(pixels) != 72:
+            pixels = await grab("")
+    
+    if len(pixels) != 72 or max(pixels) - min(pixels) < MEDIA_HASH_MIN_CONTRAST:
+        return None
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return h if is_informative_hash(h) else None
+
+
+def is_informative_hash(h: int) -> bool:
+    return MEDIA_HASH_MIN_BITS <= bin(h).count("1") <= 64 - MEDIA_HASH_MIN_BITS
+
+
+def find_similar_hash(h: int):
+    for known in recent_media_hashes:
+        if is_informative_hash(known) and bin(h ^ known).count("1") <= MEDIA_HASH_DISTANCE:
+            return known
+    return None
+
+
+async def is_duplicate_media(items: list) -> bool:
+    hashes = await asyncio.gather(*[compute_dhash(m.path, m.type) for m in items])
+    hashes = [h for h in hashes if h is not None]
+    if not hashes:
+        return False
+    if all(find_similar_hash(h) is not None for h in hashes):
+        return True
+    recent_media_hashes.extend(hashes)
+    del recent_media_hashes[:-MAX_MEDIA_HASHES]
+    return False
+
+
+def remove_media_files(items: List[MediaItem]):
+    for m in items:
+        try:
+            os.remove(m.path)
+        except:
+            pass
+
+
+def evict_pending(post_id: str, reason: str):
+    post = pending_posts.pop(post_id, None)
+    if post is None:
+        return
+    remove_post_files(post)
+    for uid, pid in list(edit_state.items()):
+        if pid == post_id:
+            del edit_state[uid]
+    logger.info(f"Evicted pending {post_id}: {reason}")
+
+
+def expire_pending(now: float = None) -> int:
+    now = now or time.time()
+    expired = [pid for pid, post in pending_posts.items() if now - post.created_at > PENDING_TTL]
+    for pid in expired:
+        evict_pending(pid, "expired")
+    return len(expired)
+
+
+def add_pending(post_id: str, post: Post):
+    pending_posts[post_id] = post
+    expire_pending()
+    while len(pending_posts) > MAX_PENDING:
+        oldest = min(pending_posts, key=lambda pid: pending_posts[pid].created_at)
+        evict_pending(oldest, "queue full")
+
+
+def compile_ad_pattern():
+    global ad_pattern
+    ad_pattern = re.compile("|".join(re.escape(kw.lower()) for kw in AD_KEYWORDS)) if AD_KEYWORDS else None
+
+
 def is_ad(text: str) -> bool:
-    if not text:
+    if not text or ad_pattern is None:
         return False
-    text_lower = text.lower()
-    return any(kw in text_lower for kw in AD_KEYWORDS)
+    return ad_pattern.search(text.lower()) is not None
 
 
 def clean_text(text: str) -> str:
@@ -192,57 +674,424 @@ def markdown_to_html(text: str) -> str:
     text = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', r'<a href="\2">\1</a>', text)
     text = re.sub(r'\*\*([^*]+)\*\*', r'<b>\1</b>', text)
     text = re.sub(r'\*([^*]+)\*', r'<i>\1</i>', text)
+    text = re.sub(r'__([^_]+)__', r'<i>\1</i>', text)
+    text = re.sub(r'~~([^~]+)~~', r'<s>\1</s>', text)
+    text = re.sub(r'\|\|([^|]+)\|\|', r'<tg-spoiler>\1</tg-spoiler>', text)
+    text = re.sub(r'```\w*\n?(.+?)```', r'<pre>\1</pre>', text, flags=re.DOTALL)
+    text = re.sub(r'`([^`\n]+)`', r'<code>\1</code>', text)
     return text
 
 
+def original_to_html(text: str) -> str:
+    return clean_text(markdown_to_html(html.escape(text or "", quote=False)))
+
+
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+ALLOWED_TAGS = {"b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a",
+                "code", "pre", "blockquote", "tg-spoiler", "span", "tg-emoji"}
+TAG_RE = re.compile(r'<(/?)([a-zA-Z][\w-]*)([^<>]*)>')
+ATTR_RE = re.compile(r'\s+([a-zA-Z-]+)(?:\s*=\s*("[^"]*"|\'[^\']*\'))?')
+TAG_ATTRS = {"a": {"href"}, "span": {"class"}, "code": {"class"}, "tg-emoji": {"emoji-id"}, "blockquote": {"expandable"}}
+REQUIRED_ATTRS = {"a": "href", "span": "class", "tg-emoji": "emoji-id"}
+ENTITY_RE = re.compile(r'&(#\d+|#x[0-9a-fA-F]+|[a-zA-Z]+);')
+
+
+def escape_text(text: str) -> str:
+    parts = []
+    pos = 0
+    for m in ENTITY_RE.finditer(text):
+        parts.append(html.escape(text[pos:m.start()], quote=False))
+        parts.append(m.group(0))
+        pos = m.end()
+    parts.append(html.escape(text[pos:], quote=False))
+    return "".join(parts)
+
+
+def is_telegram_tag(closing: str, name: str, attrs: str) -> bool:
+    if name not in ALLOWED_TAGS:
+        return False
+    if closing:
+        return not attrs.strip()
+    pos = 0
+    found = {}
+    for m in ATTR_RE.finditer(attrs):
+        if m.start() != pos:
+            return False
+        pos = m.end()
+        found[m.group(1).lower()] = m.group(2)
+    if attrs[pos:].strip():
+        return False
+    allowed = TAG_ATTRS.get(name, set())
+    for attr, value in found.items():
+        if attr not in allowed or (value is None) != (attr == "expandable"):
+            return False
+    return name not in REQUIRED_ATTRS or REQUIRED_ATTRS[name] in found
+
+
+def sanitize_html(text: str) -> str:
+    result = []
+    stack = []
+    pos = 0
+    for m in TAG_RE.finditer(text):
+        result.append(escape_text(text[pos:m.start()]))
+        pos = m.end()
+        closing, name = m.group(1), m.group(2).lower()
+        if name == "br" and m.group(3).strip() in ("", "/"):
+            result.append("\n")
+        elif not is_telegram_tag(closing, name, m.group(3)):
+            result.append(escape_text(m.group(0)))
+        elif not closing:
+            stack.append(name)
+            result.append(m.group(0))
+        elif name in stack:
+            while stack:
+                top = stack.pop()
+                result.append(f"</{top}>")
+                if top == name:
+                    break
+    result.append(escape_text(text[pos:]))
+    result.extend(f"</{name}>" for name in reversed(stack))
+    return "".join(result)
+
+
+def html_length(text: str) -> int:
+    visible = html.unescape(TAG_RE.sub("", text))
+    return len(visible.encode("utf-16-le")) // 2
+
+
+def cut_html_text(text: str, limit: int) -> str:
+    units = 0
+    pos = 0
+    while pos < len(text):
+        m = ENTITY_RE.match(text, pos) if text[pos] == "&" else None
+        end = m.end() if m else pos + 1
+        size = html_length(text[pos:end])
+        if units + size > limit:
+            break
+        units += size
+        pos = end
+    return text[:pos]
+
+
+def split_html(text: str, limit: int) -> List[str]:
+    pieces = []
+    pos = 0
+    for m in TAG_RE.finditer(text):
+        pieces += [p for p in re.split(r'(\n\n+|\s+)', text[pos:m.start()]) if p]
+        pieces.append(m.group(0))
+        pos = m.end()
+    pieces += [p for p in re.split(r'(\n\n+|\s+)', text[pos:]) if p]
+    
+    chunks = []
+    stack = []
+    i = 0
+    while i < len(pieces):
+        cur = [tag for _, tag in stack]
+        length = 0
+        paragraph = None
+        overflow = False
+        while i < len(pieces):
+            piece = pieces[i]
+            m = TAG_RE.fullmatch(piece)
+            if m:
+                if m.group(1):
+                    if stack and stack[-1][0] == m.group(2).lower():
+                        stack.pop()
+                else:
+                    stack.append((m.group(2).lower(), piece))
+                cur.append(piece)
+                i += 1
+                continue
+            if length == 0 and piece.isspace():
+                i += 1
+                continue
+            size = html_length(piece)
+            if length + size > limit:
+                overflow = True
+                break
+            cur.append(piece)
+            length += size
+            i += 1
+            if piece.startswith("\n\n"):
+                paragraph = (i, list(stack), len(cur), length)
+        
+        if overflow:
+            if paragraph and paragraph[3] > limit // 2:
+                i, stack, cut, _ = paragraph
+                cur = cur[:cut]
+            elif length == 0:
+                piece = pieces[i]
+                cut = cut_html_text(piece, limit)
+                cur.append(cut)
+                pieces[i] = piece[len(cut):]
+        
+        while cur and cur[-1].isspace():
+            cur.pop()
+        chunk = ("".join(cur) + "".join(f"</{name}>" for name, _ in reversed(stack))).strip()
+        if html_length(chunk):
+            chunks.append(chunk)
+    return chunks
+
+
+def layout_post(text: str, footer: str, has_media: bool):
+    full = sanitize_html((text or "") + footer)
+    if has_media and html_length(full) <= CAPTION_LIMIT:
+        return full, []
+    return None, split_html(full, MESSAGE_LIMIT)
+
+
+async def resolve_chat(chat: str):
+    if chat in resolved_chats:
+        return resolved_chats[chat]
+    
+    name = chat[1:] if chat.startswith("@") else chat
+    
+    if name.lstrip("-").isdigit():
+        resolved_chats[chat] = int(name)
+        return resolved_chats[chat]
+    
+    try:
+        entity = await userbot.get_entity(name)
+        resolved_chats[chat] = utils.get_peer_id(entity)
+        logger.info(f"Resolved chat @{name} to {resolved_chats[chat]}")
+        return resolved_chats[chat]
+    except Exception as e:
+        logger.error(f"Failed to resolve chat {chat}: {e}")
+    
+    return chat
+
+
 async def get_target_channel():
     global resolved_channel_id
     if resolved_channel_id:
         return resolved_channel_id
+    channel_id = await resolve_chat(TARGET_CHANNEL)
+    if isinstance(channel_id, int):
+        resolved_channel_id = channel_id
+    return channel_id
+
+
+def finish_rewrite(result: str) -> str:
+    result = markdown_to_html(result.strip())
+    return clean_text(result)
+
+
+async def request_rewrite(text: str) -> str:
+    response = await openai_client.chat.completions.create(
+        model=REWRITE_MODEL,
+        messages=[
+            {"role": "user", "content": REWRITE_PROMPT.format(text=text)}
+        ],
+        max_tokens=REWRITE_MAX_TOKENS,
+        temperature=REWRITE_TEMPERATURE
+    )
+    return response.choices[0].message.content
+
+
+async def request_rewrite_batch(texts: List[str]) -> Dict[int, str]:
+    items = json.dumps([{"id": i, "text": t} for i, t in enumerate(texts)], ensure_ascii=False)
+    response = await openai_client.chat.completions.create(
+        model=REWRITE_MODEL,
+        messages=[
+            {"role": "user", "content": REWRITE_BATCH_PROMPT.format(items=items)}
+        ],
+        max_tokens=REWRITE_MAX_TOKENS * len(texts),
+        temperature=REWRITE_TEMPERATURE,
+        response_format={"type": "json_object"}
+    )
+    data = json.loads(response.choices[0].message.content)
+    results = {}
+    for item in data.get("items", []):
+        if isinstance(item, dict) and isinstance(item.get("text"), str) and item["text"].strip():
+            try:
+                results[int(item["id"])] = item["text"]
+            except (KeyError, TypeError, ValueError):
+                pass
+    return results
+
+
+async def rewrite_single(text: str, future: asyncio.Future):
+    try:
+        result = await request_rewrite(text)
+        if not future.done():
+            future.set_result(result)
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+
+
+async def flush_rewrites(batch: list):
+    if len(batch) == 1:
+        await rewrite_single(*batch[0])
+        return
+    results = {}
+    try:
+        results = await request_rewrite_batch([text for text, _ in batch])
+        logger.info(f"Batch rewrite: {len(results)}/{len(batch)} parsed")
+    except Exception as e:
+        logger.warning(f"Batch rewrite failed, falling back: {e}")
+    fallback = []
+    for i, (text, future) in enumerate(batch):
+        if i in results:
+            if not future.done():
+                future.set_result(results[i])
+        else:
+            fallback.append(rewrite_single(text, future))
+    if fallback:
+        await asyncio.gather(*fallback)
+
+
+async def rewrite_batch_timer():
+    global rewrite_batch_task
+    await asyncio.sleep(REWRITE_BATCH_WINDOW)
+    rewrite_batch_task = None
+    while rewrite_queue:
+        batch = rewrite_queue[:REWRITE_BATCH_SIZE]
+        del rewrite_queue[:REWRITE_BATCH_SIZE]
+        spawn(flush_rewrites(batch))
+
+
+async def rewrite_via_batch_api_timer():
+    global batch_api_task
+    await asyncio.sleep(BATCH_API_WINDOW)
+    batch_api_task = None
+    batch = [item for item in batch_api_queue if still_needed(*item)]
+    batch_api_queue.clear()
+    if not batch:
+        return
     
-    channel = TARGET_CHANNEL
-    if channel.startswith("@"):
-        channel = channel[1:]
-    
-    if channel.lstrip("-").isdigit():
-        resolved_channel_id = int(channel)
-        return resolved_channel_id
-    
+    results = {}
     try:
-        entity = await userbot.get_entity(channel)
-        resolved_channel_id = int(f"-100{entity.id}")
-        logger.info(f"Resolved channel @{channel} to {resolved_channel_id}")
-        return resolved_channel_id
+        lines = []
+        for i, (text, _, _) in enumerate(batch):
+            lines.append(json.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": REWRITE_MODEL,
+                    "messages": [{"role": "user", "content": REWRITE_PROMPT.format(text=text)}],
+                    "max_tokens": REWRITE_MAX_TOKENS,
+                    "temperature": REWRITE_TEMPERATURE
+                }
+            }, ensure_ascii=False))
+        file = await openai_client.files.create(
+            file=("rewrites.jsonl", "\n".join(lines).encode()),
+            purpose="batch"
+        )
+        job = await openai_client.batches.create(
+            input_file_id=file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logger.info(f"Batch API job {job.id}: {len(batch)} rewrites")
+        
+        deadline = time.monotonic() + BATCH_API_TIMEOUT
+        while job.status not in ("completed", "failed", "expired", "cancelled") and time.monotonic() < deadline:
+            await asyncio.sleep(BATCH_API_POLL)
+            job = await openai_client.batches.retrieve(job.id)
+        
+        if job.status == "completed" and job.output_file_id:
+            content = await openai_client.files.content(job.output_file_id)
+            for line in content.text.splitlines():
+                try:
+                    row = json.loads(line)
+                    results[int(row["custom_id"])] = row["response"]["body"]["choices"][0]["message"]["content"]
+                except Exception:
+                    pass
+        elif job.status not in ("failed", "expired", "cancelled"):
+            try:
+                await openai_client.batches.cancel(job.id)
+            except Exception:
+                pass
+        logger.info(f"Batch API job {job.id}: {job.status}, {len(results)}/{len(batch)} results")
     except Exception as e:
-        logger.error(f"Failed to resolve channel: {e}")
+        logger.warning(f"Batch API failed, falling back: {e}")
     
-    return TARGET_CHANNEL
+    for i, (text, future, post_id) in enumerate(batch):
+        if not still_needed(text, future, post_id):
+            continue
+        if i in results:
+            future.set_result(results[i])
+        else:
+            enqueue_rewrite(text, future)
+
+
+def still_needed(text: str, future: asyncio.Future, post_id: str) -> bool:
+    if future.done():
+        return False
+    if post_id is not None and post_id not in pending_posts:
+        future.cancel()
+        return False
+    return True
+
 
+def enqueue_rewrite(text: str, future: asyncio.Future):
+    global rewrite_batch_task
+    rewrite_queue.append((text, future))
+    if len(rewrite_queue) >= REWRITE_BATCH_SIZE:
+        batch = rewrite_queue[:REWRITE_BATCH_SIZE]
+        del rewrite_queue[:REWRITE_BATCH_SIZE]
+        spawn(flush_rewrites(batch))
+    elif rewrite_batch_task is None:
+        rewrite_batch_task = spawn(rewrite_batch_timer())
 
-async def rewrite_text(text: str) -> str:
+
+async def rewrite_text(text: str, urgent: bool = True, post_id: str = None) -> str:
     if not text or len(text) < 20:
-        return clean_text(text)
+        return original_to_html(text)
+    global batch_api_task
+    future = asyncio.get_running_loop().create_future()
+    if not urgent and REWRITE_BATCH_API:
+        batch_api_queue.append((text, future, post_id))
+        if batch_api_task is None:
+            batch_api_task = spawn(rewrite_via_batch_api_timer())
+    else:
+        enqueue_rewrite(text, future)
     try:
-        response = await openai_client.chat.completions.create(
-            model="gpt-4.1",
-            messages=[
-                {"role": "user", "content": REWRITE_PROMPT.format(text=text)}
-            ],
-            max_tokens=500,
-            temperature=0.7
-        )
-        result = response.choices[0].message.content.strip()
-        result = markdown_to_html(result)
-        result = clean_text(result)
-        return result
+        return finish_rewrite(await future)
     except Exception as e:
         logger.error(f"OpenAI error: {e}")
         inc_stat("errors")
-        return clean_text(text)
+        return original_to_html(text)
+
+
+async def ensure_rewritten(post: Post, post_id: str):
+    if post.rewritten:
+        return
+    task = rewrite_tasks.get(post_id)
+    if task is None:
+        task = asyncio.create_task(rewrite_text(post.original))
+        rewrite_tasks[post_id] = task
+    try:
+        result = await task
+    finally:
+        rewrite_tasks.pop(post_id, None)
+    if not post.rewritten:
+        if result:
+            post.text = result
+        post.rewritten = True
 
 
-def create_keyboard(post_id: str) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
+def defer_rewrite(post: Post, post_id: str):
+    task = asyncio.create_task(deferred_rewrite(post, post_id))
+    deferred_rewrites.add(task)
+    task.add_done_callback(deferred_rewrites.discard)
+
+
+async def deferred_rewrite(post: Post, post_id: str):
+    result = await rewrite_text(post.original, urgent=False, post_id=post_id)
+    if not post.rewritten and post_id in pending_posts:
+        post.text = result
+        post.rewritten = True
+        logger.info(f"Backfill rewrite ready: {post_id}")
+        await clear_preview_keyboard(post)
+        await send_preview_to_admin(post, post_id)
+
+
+def create_keyboard(post_id: str, rewrite: bool = False) -> InlineKeyboardMarkup:
+    rows = [
         [
             InlineKeyboardButton(text="✅ Опубликовать", callback_data=f"pub:{post_id[:50]}"),
             InlineKeyboardButton(text="❌ Пропустить", callback_data=f"skip:{post_id[:50]}")
@@ -251,115 +1100,288 @@ def create_keyboard(post_id: str) -> InlineKeyboardMarkup:
             InlineKeyboardButton(text="⏰ Через час", callback_data=f"delay:{post_id[:50]}"),
             InlineKeyboardButton(text="✏️ Редактировать", callback_data=f"edit:{post_id[:50]}")
         ]
-    ])
+    ]
+    if rewrite:
+        rows.append([InlineKeyboardButton(text="✨ Переписать", callback_data=f"rw:{post_id[:50]}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-async def send_preview_to_admin(post_data: dict, post_id: str):
+async def run_ffmpeg(args: list, timeout: float = PREVIEW_TIMEOUT) -> bool:
+    proc = await asyncio.create_subprocess_exec(
+        FFMPEG, "-y", "-v", "error", *args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
     try:
-        text_with_footer = (post_data["text"] + CHANNEL_FOOTER) if post_data["text"] else CHANNEL_FOOTER
-        caption = text_with_footer if len(text_with_footer) <= 1024 else text_with_footer[:1020] + "..."
-        
-        await bot.send_message(ADMIN_ID, f"📍 @{post_data['source']}")
+        _, err = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        logger.warning(f"ffmpeg timeout: {args[1] if len(args) > 1 else args}")
+        return False
+    if proc.returncode != 0:
+        logger.warning(f"ffmpeg error: {err.decode(errors='ignore')[:200]}")
+        return False
+    return True
+
+
+async def make_preview(path: str, media_type: str) -> str:
+    if not PREVIEW_COMPRESS or not FFMPEG:
+        return path
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return path
+    if size < PREVIEW_MIN_BYTES:
+        return path
+    
+    base = os.path.splitext(path)[0]
+    if media_type == "photo":
+        out = f"{base}_preview.jpg"
+        args = ["-i", path,
+                "-vf", f"scale=w='min({PREVIEW_MAX_SIDE},iw)':h='min({PREVIEW_MAX_SIDE},ih)':force_original_aspect_ratio=decrease",
+                "-q:v", "5", out]
+    elif media_type in ("video", "gif"):
+        out = f"{base}_preview.mp4"
+        args = ["-i", path,
+                "-vf", f"scale=-2:'min({PREVIEW_VIDEO_HEIGHT},ih)'",
+                "-c:v", "libx264", "-preset", "veryfast", "-crf", "32", "-pix_fmt", "yuv420p",
+                "-movflags", "+faststart"]
+        args += ["-an"] if media_type == "gif" else ["-c:a", "aac", "-b:a", "64k"]
+        args.append(out)
+    else:
+        return path
+    
+    async with ffmpeg_semaphore:
+        ok = await run_ffmpeg(args)
+    
+    if ok and os.path.exists(out) and os.path.getsize(out) < size:
+        logger.info(f"  Preview {media_type}: {size // 1024}KB -> {os.path.getsize(out) // 1024}KB")
+        return out
+    try:
+        os.remove(out)
+    except:
+        pass
+    return path
+
+
+async def send_text_chunks(chat_id, chunks: List[str], reply_markup=None) -> list:
+    sent = []
+    for n, chunk in enumerate(chunks):
+        markup = reply_markup if n == len(chunks) - 1 else None
+        try:
+            sent.append(await bot.send_message(chat_id, chunk, reply_markup=markup, parse_mode="HTML"))
+        except Exception as e:
+            if "can't parse" in str(e).lower():
+                logger.warning(f"HTML parse error, retrying without parse_mode: {e}")
+                sent.append(await bot.send_message(chat_id, chunk, reply_markup=markup))
+            else:
+                raise
+    return sent
+
+
+async def send_single_media(chat_id, media_type: str, file, caption: str = None, reply_markup=None):
+    if media_type == "photo":
+        return await bot.send_photo(chat_id, file, caption=caption, reply_markup=reply_markup, parse_mode="HTML")
+    elif media_type == "video":
+        return await bot.send_video(chat_id, file, caption=caption, reply_markup=reply_markup, parse_mode="HTML")
+    elif media_type == "gif":
+        return await bot.send_animation(chat_id, file, caption=caption, reply_markup=reply_markup, parse_mode="HTML")
+    return None
+
+
+def build_media_group(items: list, caption: str = None) -> list:
+    media_group = []
+    for media_type, file in items:
+        cap = caption if not media_group else None
+        if media_type == "photo":
+            media_group.append(InputMediaPhoto(media=file, caption=cap, parse_mode="HTML"))
+        elif media_type == "video":
+            media_group.append(InputMediaVideo(media=file, caption=cap, parse_mode="HTML"))
+    return media_group
+
+
+async def clear_preview_keyboard(post: Post):
+    if not post.preview_id:
+        return
+    try:
+        await bot.edit_message_reply_markup(chat_id=ADMIN_ID, message_id=post.preview_id, reply_markup=None)
+    except:
+        pass
+
+
+async def send_preview_to_admin(post_data: Post, post_id: str):
+    previews = []
+    sent = []
+    try:
+        keyboard = create_keyboard(post_id, rewrite=not post_data.rewritten)
+        header = f"📍 @{post_data.source}"
+        if post_data.score is not None:
+            header += f" · {post_data.score:.0%}"
+        await bot.send_message(ADMIN_ID, header)
         
-        if post_data.get("media_group") and len(post_data["media_group"]) >= 1:
-            media_group = []
-            for i, media in enumerate(post_data["media_group"]):
-                if not os.path.exists(media["path"]):
-                    continue
-                file = FSInputFile(media["path"])
-                cap = caption if i == 0 else None
-                if media["type"] == "photo":
-                    media_group.append(InputMediaPhoto(media=file, caption=cap, parse_mode="HTML"))
-                elif media["type"] == "video":
-                    media_group.append(InputMediaVideo(media=file, caption=cap, parse_mode="HTML"))
+        if post_data.media_group:
+            available = [m for m in post_data.media_group if os.path.exists(m.path)]
+            paths = await asyncio.gather(*[make_preview(m.path, m.type) for m in available])
+            previews = [p for p, m in zip(paths, available) if p != m.path]
+            caption, texts = layout_post(post_data.text, CHANNEL_FOOTER, has_media=True)
+            media_group = build_media_group([(m.type, FSInputFile(p)) for m, p in zip(available, paths)], caption)
             
             if media_group:
                 await bot.send_media_group(ADMIN_ID, media_group)
-                await bot.send_message(ADMIN_ID, "👆", reply_markup=create_keyboard(post_id))
+                if texts:
+                    sent = await send_text_chunks(ADMIN_ID, texts, reply_markup=keyboard)
+                else:
+                    sent = [await bot.send_message(ADMIN_ID, "👆", reply_markup=keyboard)]
         
-        elif post_data.get("media_path") and os.path.exists(post_data["media_path"]):
-            file = FSInputFile(post_data["media_path"])
-            if post_data["media_type"] == "photo":
-                await bot.send_photo(ADMIN_ID, file, caption=caption, reply_markup=create_keyboard(post_id), parse_mode="HTML")
-            elif post_data["media_type"] == "video":
-                await bot.send_video(ADMIN_ID, file, caption=caption, reply_markup=create_keyboard(post_id), parse_mode="HTML")
-            elif post_data["media_type"] == "gif":
-                await bot.send_animation(ADMIN_ID, file, caption=caption, reply_markup=create_keyboard(post_id), parse_mode="HTML")
+        elif post_data.media_path and os.path.exists(post_data.media_path):
+            path = await make_preview(post_data.media_path, post_data.media_type)
+            if path != post_data.media_path:
+                previews.append(path)
+            caption, texts = layout_post(post_data.text, CHANNEL_FOOTER, has_media=True)
+            msg = await send_single_media(ADMIN_ID, post_data.media_type, FSInputFile(path), caption,
+                                          reply_markup=None if texts else keyboard)
+            sent = await send_text_chunks(ADMIN_ID, texts, reply_markup=keyboard) if texts else [msg]
         else:
-            await bot.send_message(ADMIN_ID, caption, reply_markup=create_keyboard(post_id), parse_mode="HTML")
+            _, texts = layout_post(post_data.text, CHANNEL_FOOTER, has_media=False)
+            sent = await send_text_chunks(ADMIN_ID, texts, reply_markup=keyboard)
+        
+        if sent and sent[-1]:
+            post_data.preview_id = sent[-1].message_id
         
     except Exception as e:
         logger.error(f"Preview error: {e}")
         inc_stat("errors")
-
-
-async def publish_post(post: dict, post_id: str) -> bool:
-    try:
-        channel_id = await get_target_channel()
-        text_with_footer = (post["text"] + CHANNEL_FOOTER) if post["text"] else CHANNEL_FOOTER
-        
-        if post.get("media_group") and len(post["media_group"]) > 0:
-            media_group = []
-            for i, media in enumerate(post["media_group"]):
-                if not os.path.exists(media["path"]):
-                    logger.warning(f"File not found: {media['path']}")
-                    continue
-                file = FSInputFile(media["path"])
-                caption = text_with_footer if i == 0 else None
-                if media["type"] == "photo":
-                    media_group.append(InputMediaPhoto(media=file, caption=caption, parse_mode="HTML"))
-                elif media["type"] == "video":
-                    media_group.append(InputMediaVideo(media=file, caption=caption, parse_mode="HTML"))
-            
-            if media_group:
-                await bot.send_media_group(channel_id, media_group)
-            else:
-                logger.error("No valid media in group")
-                return False
-            
-            for media in post["media_group"]:
-                try:
-                    os.remove(media["path"])
-                except:
-                    pass
-                    
-        elif post.get("media_path") and os.path.exists(post["media_path"]):
-            file = FSInputFile(post["media_path"])
+    finally:
+        for path in previews:
             try:
-                if post.get("media_type") == "photo":
-                    await bot.send_photo(channel_id, file, caption=text_with_footer, parse_mode="HTML")
-                elif post.get("media_type") == "video":
-                    await bot.send_video(channel_id, file, caption=text_with_footer, parse_mode="HTML")
-                elif post.get("media_type") == "gif":
-                    await bot.send_animation(channel_id, file, caption=text_with_footer, parse_mode="HTML")
-            except Exception as e:
-                if "can't parse" in str(e).lower():
-                    logger.warning(f"HTML parse error, retrying without parse_mode: {e}")
-                    file = FSInputFile(post["media_path"])
-                    if post.get("media_type") == "photo":
-                        await bot.send_photo(channel_id, file, caption=text_with_footer)
-                    elif post.get("media_type") == "video":
-                        await bot.send_video(channel_id, file, caption=text_with_footer)
-                    elif post.get("media_type") == "gif":
-                        await bot.send_animation(channel_id, file, caption=text_with_footer)
-                else:
-                    raise
-            try:
-                os.remove(post["media_path"])
+                os.remove(path)
             except:
                 pass
+
+
+def record_published(post_id: str, chat_id, message_ids: list):
+    record = published_posts.setdefault(post_id, {"targets": {}, "time": datetime.now().isoformat()})
+    record["targets"][str(chat_id)] = message_ids
+    while len(published_posts) > MAX_PUBLISHED:
+        published_posts.pop(next(iter(published_posts)))
+
+
+class ChatLimiter:
+    def __init__(self, chat_id):
+        self.chat_id = str(chat_id)
+
+    async def __aenter__(self):
+        limit = chat_limits.setdefault(self.chat_id, {"lock": asyncio.Lock(), "last": 0.0})
+        await limit["lock"].acquire()
+        wait = limit["last"] + CHAT_SEND_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def __aexit__(self, *exc):
+        limit = chat_limits[self.chat_id]
+        limit["last"] = time.monotonic()
+        limit["lock"].release()
+
+
+def post_media(post: Post) -> list:
+    if post.file_ids:
+        return [(f.type, f.file_id) for f in post.file_ids]
+    if post.media_group:
+        available = []
+        for media in post.media_group:
+            if not os.path.exists(media.path):
+                logger.warning(f"File not found: {media.path}")
+                continue
+            available.append((media.type, FSInputFile(media.path)))
+        return available
+    if post.media_path and os.path.exists(post.media_path):
+        return [(post.media_type, FSInputFile(post.media_path))]
+    return []
+
+
+def extract_file_ids(sent: list) -> List[FileRef]:
+    file_ids = []
+    for msg in sent:
+        if msg.photo:
+            file_ids.append(FileRef(msg.photo[-1].file_id, "photo"))
+        elif msg.animation:
+            file_ids.append(FileRef(msg.animation.file_id, "gif"))
+        elif msg.video:
+            file_ids.append(FileRef(msg.video.file_id, "video"))
+    return file_ids
+
+
+def remove_post_files(post: Post):
+    items = list(post.media_group or [])
+    if post.media_path:
+        items.append(MediaItem(post.media_path, post.media_type))
+    remove_media_files(items)
+
+
+async def send_to_target(post: Post, target: dict):
+    chat_id = await resolve_chat(target["chat"])
+    media = post_media(post)
+    is_group = bool(post.media_group) or len(media) > 1
+    
+    async with ChatLimiter(chat_id):
+        if is_group:
+            if not media:
+                raise ValueError("No valid media in group")
+            caption, texts = layout_post(post.text, target["footer"], has_media=True)
+            sent = await bot.send_media_group(chat_id, build_media_group(media, caption))
+            sent += await send_text_chunks(chat_id, texts)
+        elif media:
+            caption, texts = layout_post(post.text, target["footer"], has_media=True)
+            media_type, file = media[0]
+            msg = await send_single_media(chat_id, media_type, file, caption)
+            sent = ([msg] if msg else []) + await send_text_chunks(chat_id, texts)
         else:
-            try:
-                await bot.send_message(channel_id, text_with_footer, parse_mode="HTML")
-            except Exception as e:
-                if "can't parse" in str(e).lower():
-                    logger.warning(f"HTML parse error, retrying without parse_mode: {e}")
-                    await bot.send_message(channel_id, text_with_footer)
-                else:
-                    raise
+            _, texts = layout_post(post.text, target["footer"], has_media=False)
+            sent = await send_text_chunks(chat_id, texts)
+    
+    return chat_id, sent
+
+
+async def publish_post(post: Post, post_id: str) -> bool:
+    try:
+        if LAZY_REWRITE:
+            await ensure_rewritten(post, post_id)
+        
+        fanout = post.targets is not None
+        indexes = post.targets if fanout else list(range(len(PUBLISH_TARGETS)))
+        now_targets = [i for i in indexes if fanout or not PUBLISH_TARGETS[i]["delay_minutes"]]
+        later_targets = [i for i in indexes if i not in now_targets]
+        
+        chat_id, sent = await send_to_target(post, PUBLISH_TARGETS[now_targets[0]])
+        record_published(post_id.split("@")[0], chat_id, [m.message_id for m in sent])
+        logger.info(f"Published: {post_id} -> {chat_id} {[m.message_id for m in sent]}")
+        
+        if not post.file_ids and (post.media_group or post.media_path):
+            post.file_ids = extract_file_ids(sent) or None
         
-        inc_stat("published", post.get("source"))
-        logger.info(f"Published: {post_id}")
+        results = await asyncio.gather(
+            *[send_to_target(post, PUBLISH_TARGETS[i]) for i in now_targets[1:]],
+            return_exceptions=True
+        )
+        for i, result in zip(now_targets[1:], results):
+            if isinstance(result, Exception):
+                logger.error(f"Publish error ({PUBLISH_TARGETS[i]['chat']}): {result}")
+                inc_stat("errors")
+                continue
+            chat_id, target_sent = result
+            record_published(post_id.split("@")[0], chat_id, [m.message_id for m in target_sent])
+            logger.info(f"Published: {post_id} -> {chat_id} {[m.message_id for m in target_sent]}")
+        
+        for i in later_targets:
+            publish_time = datetime.now() + timedelta(minutes=PUBLISH_TARGETS[i]["delay_minutes"])
+            scheduled_posts[f"{post_id}@{i}"] = (publish_time, replace(post, targets=[i]))
+        
+        if post.file_ids or not later_targets:
+            remove_post_files(post)
+        
+        if not fanout:
+            inc_stat("published", post.source)
         return True
     except Exception as e:
         logger.error(f"Publish error: {e}")
@@ -372,12 +1394,19 @@ async def scheduled_publisher():
         now = datetime.now()
         to_publish = [pid for pid, (pt, _) in list(scheduled_posts.items()) if now >= pt]
         for post_id in to_publish:
-            _, post = scheduled_posts.pop(post_id)
+            if shutdown_event.is_set():
+                break
+            publish_time, post = scheduled_posts.pop(post_id)
+            task = spawn(publish_post(post, post_id))
             try:
-                if await publish_post(post, post_id):
+                if await asyncio.shield(task):
                     await bot.send_message(ADMIN_ID, "⏰ Отложенный пост опубликован")
                 else:
                     await bot.send_message(ADMIN_ID, f"❌ Ошибка публикации отложенного поста")
+            except asyncio.CancelledError:
+                if not task.done():
+                    scheduled_posts[post_id] = (publish_time, post)
+                raise
             except Exception as e:
                 logger.error(f"Scheduled publish error: {e}")
                 await bot.send_message(ADMIN_ID, f"❌ Ошибка: {str(e)[:100]}")
@@ -385,23 +1414,27 @@ async def scheduled_publisher():
 
 
 async def process_media_group(group_id: int):
-    await asyncio.sleep(MEDIA_GROUP_TIMEOUT)
+    try:
+        await asyncio.wait_for(shutdown_event.wait(), MEDIA_GROUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
     
+    async with post_slots:
+        await build_group_post(group_id)
+
+
+async def build_group_post(group_id: int):
     if group_id not in media_groups:
         return
     
     group_data = media_groups.pop(group_id)
-    messages = sorted(group_data["messages"], key=lambda m: m.id)
-    source = group_data["source"]
+    messages = sorted(group_data.items, key=lambda m: m.id)
+    source = group_data.source
     
     logger.info(f"GROUP: @{source} | {len(messages)} items | id={group_id}")
     inc_stat("received", source)
     
-    text = ""
-    for msg in messages:
-        if msg.text or msg.message:
-            text = msg.text or msg.message
-            break
+    text = next((msg.text for msg in messages if msg.text), "")
     
     if is_ad(text):
         logger.info(f"  SKIP: ad")
@@ -413,22 +1446,26 @@ async def process_media_group(group_id: int):
         inc_stat("filtered_duplicate", source)
         return
     
-    rewritten = await rewrite_text(text) if text else ""
+    if is_duplicate_media_ids([get_media_id(msg) for msg in messages]):
+        logger.info(f"  SKIP: duplicate media id")
+        inc_stat("filtered_duplicate", source)
+        return
+    
     post_id = f"g{group_id}"
     
     media_list = []
     for i, msg in enumerate(messages):
         try:
             if isinstance(msg.media, MessageMediaPhoto):
-                path = await msg.download_media(file=f"/tmp/{post_id}_{i}.jpg")
+                path = await userbot.download_media(msg.media, file=f"{MEDIA_DIR}/{post_id}_{i}.jpg")
                 if path:
-                    media_list.append({"path": path, "type": "photo"})
+                    media_list.append(MediaItem(path, "photo"))
             elif isinstance(msg.media, MessageMediaDocument):
-                mime = msg.file.mime_type or ""
+                mime = getattr(msg.media.document, "mime_type", None) or ""
                 if mime.startswith("video"):
-                    path = await msg.download_media(file=f"/tmp/{post_id}_{i}.mp4")
+                    path = await userbot.download_media(msg.media, file=f"{MEDIA_DIR}/{post_id}_{i}.mp4")
                     if path:
-                        media_list.append({"path": path, "type": "video"})
+                        media_list.append(MediaItem(path, "video"))
         except Exception as e:
             logger.error(f"  Download error: {e}")
     
@@ -436,38 +1473,75 @@ async def process_media_group(group_id: int):
         logger.info(f"  SKIP: no media")
         return
     
-    post_data = {
-        "text": rewritten,
-        "original": text,
-        "source": source,
-        "media_path": None,
-        "media_type": None,
-        "media_group": media_list
-    }
+    if await is_duplicate_media(media_list):
+        logger.info(f"  SKIP: duplicate media")
+        inc_stat("filtered_duplicate", source)
+        remove_media_files(media_list)
+        return
     
-    pending_posts[post_id] = post_data
+    score = score_relevance(text, source)
+    if score is not None and score < RELEVANCE_DROP:
+        logger.info(f"  SKIP: low score {score:.2f}")
+        inc_stat("filtered_score", source)
+        remove_media_files(media_list)
+        return
+    
+    rewrite = not LAZY_REWRITE and (score is None or score >= RELEVANCE_THRESHOLD)
+    deferred = rewrite and REWRITE_BATCH_API and is_backfill(messages[0])
+    rewrite = rewrite and not deferred
+    rewritten = (await rewrite_text(text) if rewrite else original_to_html(text)) if text else ""
+    
+    post_data = Post(
+        text=rewritten,
+        original=text,
+        source=source,
+        media_group=media_list,
+        score=score,
+        rewritten=rewrite or not text
+    )
+    
+    add_pending(post_id, post_data)
+    if deferred and text:
+        defer_rewrite(post_data, post_id)
     await send_preview_to_admin(post_data, post_id)
     logger.info(f"  SENT to admin: {post_id} ({len(media_list)} media)")
 
 
 async def handle_new_post(event):
+    if boot_time and "first_event" not in startup_timings:
+        startup_timings["first_event"] = time.monotonic() - boot_time
+        logger.info(f"First event {startup_timings['first_event']:.1f}s after boot")
+    track_task(asyncio.current_task())
     try:
         chat = await event.get_chat()
         source = getattr(chat, 'username', None) or getattr(chat, 'title', None) or "unknown"
-        text = event.message.text or event.message.message or ""
-        has_media = event.message.media is not None
-        grouped_id = event.message.grouped_id
-        msg_id = event.message.id
+    except Exception as e:
+        logger.error(f"HANDLER ERROR: {e}")
+        return
+    await process_message(event.message, source, event.chat_id)
+
+
+async def process_message(message, source: str, chat_id: int):
+    if not note_update(chat_id, source, message.id):
+        return
+    acquired = False
+    try:
+        text = message.text or message.message or ""
+        has_media = message.media is not None
+        grouped_id = message.grouped_id
+        msg_id = message.id
         
         logger.info(f"NEW: @{source} | msg={msg_id} | {len(text)} chars | media={has_media} | group={grouped_id}")
         
         if grouped_id:
             if grouped_id not in media_groups:
-                media_groups[grouped_id] = {"messages": [], "source": source}
-                asyncio.create_task(process_media_group(grouped_id))
-            media_groups[grouped_id]["messages"].append(event.message)
+                media_groups[grouped_id] = GroupBuffer(source)
+                spawn(process_media_group(grouped_id))
+            media_groups[grouped_id].items.append(GroupItem(msg_id, text, message.media, message.date))
             return
         
+        await post_slots.acquire()
+        acquired = True
         inc_stat("received", source)
         
         if not text and not has_media:
@@ -488,60 +1562,93 @@ async def handle_new_post(event):
             inc_stat("filtered_duplicate", source)
             return
         
-        rewritten = await rewrite_text(text) if text else ""
-        post_id = f"{msg_id}_{int(event.message.date.timestamp())}"
+        if is_duplicate_media_ids([get_media_id(message)]):
+            logger.info(f"  SKIP: duplicate media id")
+            inc_stat("filtered_duplicate", source)
+            return
+        
+        post_id = f"{msg_id}_{int(message.date.timestamp())}"
         
-        post_data = {
-            "text": rewritten,
-            "original": text,
-            "source": source,
-            "media_path": None,
-            "media_type": None,
-            "media_group": None
-        }
+        post_data = Post(text="", original=text, source=source)
         
-        if event.message.media:
+        if message.media:
             try:
-                if isinstance(event.message.media, MessageMediaPhoto):
-                    path = await event.message.download_media(file=f"/tmp/{post_id}.jpg")
-                    post_data["media_path"] = path
-                    post_data["media_type"] = "photo"
-                elif isinstance(event.message.media, MessageMediaDocument):
-                    mime = event.message.file.mime_type or ""
+                if isinstance(message.media, MessageMediaPhoto):
+                    path = await message.download_media(file=f"{MEDIA_DIR}/{post_id}.jpg")
+                    post_data.media_path = path
+                    post_data.media_type = "photo"
+                elif isinstance(message.media, MessageMediaDocument):
+                    mime = message.file.mime_type or ""
                     if mime.startswith("video"):
-                        path = await event.message.download_media(file=f"/tmp/{post_id}.mp4")
-                        post_data["media_path"] = path
-                        post_data["media_type"] = "video"
+                        path = await message.download_media(file=f"{MEDIA_DIR}/{post_id}.mp4")
+                        post_data.media_path = path
+                        post_data.media_type = "video"
                     elif "gif" in mime:
-                        path = await event.message.download_media(file=f"/tmp/{post_id}.gif")
-                        post_data["media_path"] = path
-                        post_data["media_type"] = "gif"
+                        path = await message.download_media(file=f"{MEDIA_DIR}/{post_id}.gif")
+                        post_data.media_path = path
+                        post_data.media_type = "gif"
             except Exception as e:
                 logger.error(f"  Media error: {e}")
         
-        if not rewritten and not post_data["media_path"]:
+        if post_data.media_path:
+            media = [MediaItem(post_data.media_path, post_data.media_type)]
+            if await is_duplicate_media(media):
+                logger.info(f"  SKIP: duplicate media")
+                inc_stat("filtered_duplicate", source)
+                remove_media_files(media)
+                return
+        
+        score = score_relevance(text, source)
+        if score is not None and score < RELEVANCE_DROP:
+            logger.info(f"  SKIP: low score {score:.2f}")
+            inc_stat("filtered_score", source)
+            if post_data.media_path:
+                remove_media_files([MediaItem(post_data.media_path, post_data.media_type)])
+            return
+        
+        rewrite = not LAZY_REWRITE and (score is None or score >= RELEVANCE_THRESHOLD)
+        deferred = rewrite and REWRITE_BATCH_API and is_backfill(message)
+        rewrite = rewrite and not deferred
+        rewritten = (await rewrite_text(text) if rewrite else original_to_html(text)) if text else ""
+        post_data.text = rewritten
+        post_data.score = score
+        post_data.rewritten = rewrite or not text
+        
+        if not rewritten and not post_data.media_path:
             logger.info(f"  SKIP: no content")
             return
         
-        pending_posts[post_id] = post_data
+        add_pending(post_id, post_data)
+        if deferred and text:
+            defer_rewrite(post_data, post_id)
         await send_preview_to_admin(post_data, post_id)
         logger.info(f"  SENT to admin: {post_id}")
             
     except Exception as e:
         logger.error(f"HANDLER ERROR: {e}")
+    finally:
+        if acquired:
+            post_slots.release()
 
 
 @dp.message(CommandStart())
 async def start_handler(message: types.Message):
     if message.from_user.id == ADMIN_ID:
-        await message.answer("✅ Бот работает\n\n/stats — статистика\n/channels — проверка каналов\n/fetch @channel — получить пост\n/test — тест кнопок\n/debug — диагностика\n/cleanup — очистка")
+        await message.answer("✅ Бот работает\n\n/stats [15m|1h|6h|24h|48h] — статистика\n/channels — проверка каналов\n/fetch @channel — получить пост\n/publish_all — опубликовать всю очередь по порядку, по одному посту\n/test — тест кнопок\n/debug — диагностика\n/profile start|stop — профилирование\n/config, /set, /add_source, /remove_source — настройки\n/cleanup — очистка")
 
 
-@dp.message(Command("stats"))
-async def stats_handler(message: types.Message):
-    if message.from_user.id != ADMIN_ID:
-        return
-    
+def render_window_stats(label: str, window: int) -> str:
+    received = series_total("received", window)
+    published = series_total("published", window)
+    filtered = sum(series_total(k, window) for k in ("filtered_ad", "filtered_duplicate", "filtered_score"))
+    tracked = min(window, max(60, time.time() - (series_since or time.time())))
+    per_hour = received / (tracked / 3600)
+    filter_ratio = filtered / received * 100 if received else 0
+    publish_ratio = published / received * 100 if received else 0
+    return f"🕒 {label}: 📥 {received} ({per_hour:.1f}/ч) | ✅ {published} ({publish_ratio:.0f}%) | 🚫 {filter_ratio:.0f}%"
+
+
+def render_stats(windows: List[str]) -> str:
     uptime = ""
     if stats["start_time"]:
         start = datetime.fromisoformat(stats["start_time"])
@@ -550,17 +1657,42 @@ async def stats_handler(message: types.Message):
         minutes = int((delta.total_seconds() % 3600) // 60)
         uptime = f"⏱ {hours}ч {minutes}м\n\n"
     
+    window_stats = "\n".join(render_window_stats(w, STATS_WINDOWS[w]) for w in windows)
+    
+    quiet_window = max(STATS_WINDOWS[w] for w in windows)
     source_stats = ""
     for src, data in stats.get("by_source", {}).items():
-        source_stats += f"@{src}: {data['received']} → {data['published']}\n"
+        recent = series_total("received", quiet_window, src)
+        quiet = " 💤" if data["received"] and not recent and series_covers(quiet_window) else ""
+        source_stats += f"@{src}: {data['received']} → {data['published']} ({recent} за {windows[-1]}){quiet}\n"
     
-    text = f"""📊 Статистика
+    return f"""📊 Статистика
 
 {uptime}📥 {stats.get('received', 0)} | ✅ {stats.get('published', 0)} | ❌ {stats.get('skipped', 0)}
-🚫 Реклама: {stats.get('filtered_ad', 0)} | 🔄 Дубли: {stats.get('filtered_duplicate', 0)}
+🚫 Реклама: {stats.get('filtered_ad', 0)} | 🔄 Дубли: {stats.get('filtered_duplicate', 0)} | 📉 Скоринг: {stats.get('filtered_score', 0)}
+
+{window_stats}
 
 {source_stats if source_stats else ''}
-⏳ Очередь: {len(pending_posts)} | 📅 Отложено: {len(scheduled_posts)}"""
+⏳ Очередь: {len(pending_posts)}/{MAX_PENDING} | 📅 Отложено: {len(scheduled_posts)}"""
+
+
+@dp.message(Command("stats"))
+async def stats_handler(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    args = message.text.split()[1:]
+    windows = [w for w in args if w in STATS_WINDOWS] or ["1h", "24h"]
+    windows.sort(key=lambda w: STATS_WINDOWS[w])
+    
+    key = (stats_version, tuple(windows), int(time.time() // 60), len(pending_posts), len(scheduled_posts))
+    cached = stats_render_cache.get(tuple(windows))
+    if cached and cached[0] == key:
+        text = cached[1]
+    else:
+        text = render_stats(windows)
+        stats_render_cache[tuple(windows)] = (key, text)
     
     await message.answer(text)
 
@@ -569,11 +1701,15 @@ async def stats_handler(message: types.Message):
 async def reset_stats_handler(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         return
-    global stats
+    global stats, series_since
     stats = {"received": 0, "published": 0, "skipped": 0, "filtered_ad": 0, 
              "filtered_duplicate": 0, "delayed": 0, "errors": 0, "by_source": {},
              "start_time": datetime.now().isoformat()}
+    series.clear()
+    series_since = time.time()
+    stats_render_cache.clear()
     save_stats()
+    save_series()
     await message.answer("🔄 Сброшено")
 
 
@@ -585,9 +1721,12 @@ async def cleanup_handler(message: types.Message):
     deleted_files = 0
     deleted_bytes = 0
     
-    for f in os.listdir("/tmp"):
+    keep = referenced_media()
+    for f in os.listdir(MEDIA_DIR):
         if f.endswith((".jpg", ".mp4", ".gif", ".png", ".webp")):
-            path = f"/tmp/{f}"
+            path = os.path.join(MEDIA_DIR, f)
+            if path in keep:
+                continue
             try:
                 size = os.path.getsize(path)
                 os.remove(path)
@@ -598,6 +1737,8 @@ async def cleanup_handler(message: types.Message):
     
     media_groups.clear()
     recent_hashes.clear()
+    recent_media_ids.clear()
+    recent_media_hashes.clear()
     
     mb = deleted_bytes / 1024 / 1024
     await message.answer(f"🧹 Очищено:\n• {deleted_files} файлов ({mb:.1f}MB)\n• Кэш дубликатов сброшен")
@@ -609,16 +1750,13 @@ async def test_handler(message: types.Message):
         return
     
     post_id = f"test_{int(datetime.now().timestamp())}"
-    post_data = {
-        "text": "Тестовый пост для проверки работы бота.\n\nВсе кнопки должны работать корректно.",
-        "original": "Тестовый текст",
-        "source": "test_channel",
-        "media_path": None,
-        "media_type": None,
-        "media_group": None
-    }
+    post_data = Post(
+        text="Тестовый пост для проверки работы бота.\n\nВсе кнопки должны работать корректно.",
+        original="Тестовый текст",
+        source="test_channel"
+    )
     
-    pending_posts[post_id] = post_data
+    add_pending(post_id, post_data)
     await send_preview_to_admin(post_data, post_id)
     logger.info(f"Test post created: {post_id}")
 
@@ -657,27 +1795,139 @@ async def debug_handler(message: types.Message):
     handler_info = f"Event handlers: {len(handlers)}\n"
     for callback, event in handlers:
         handler_info += f"• {callback.__name__}: {type(event).__name__}\n"
-        if hasattr(event, 'chats') and event.chats:
-            handler_info += f"  Chats: {len(event.chats)} IDs\n"
+        if callback is handle_new_post:
+            handler_info += f"  Chats: {len(source_chat_ids)} IDs\n"
+    
+    entities_info = f"IDs: {registered_entities[:5]}{'...' if len(registered_entities) > 5 else ''}\n" if registered_entities else "None\n"
+    
+    me = await userbot.get_me()
+    channel_id = await get_target_channel()
+    
+    text = f"""🔧 Debug info
+
+👤 Userbot: @{me.username} (id={me.id})
+📡 Connected: {userbot.is_connected()}
+{format_connection()}
+📢 Target: {channel_id}
+
+{handler_info}
+📋 Registered: {len(registered_entities)} channels
+{entities_info}⏱ Startup: {format_startup_timings()}
+
+{format_loop_health()}
+🧵 Tasks:
+{format_tasks()}
+
+📊 Pending: {len(pending_posts)}
+📅 Scheduled: {len(scheduled_posts)}"""
+    
+    await message.answer(text)
+
+
+@dp.message(Command("config"))
+async def config_handler(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    tunables = "\n".join(f"{key} = {globals()[key]}" for key in TUNABLES)
+    await message.answer(f"⚙️ Конфиг ({CONFIG_FILE})\n\n📡 Источники: {len(SOURCE_CHANNELS)}\n🚫 Стоп-слова: {len(AD_KEYWORDS)}\n\n{tunables}")
+
+
+@dp.message(Command("add_source"))
+async def add_source_handler(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer("Использование: /add_source channel_name")
+        return
+    
+    channel = args[1].strip().replace("@", "")
+    try:
+        await add_source(channel)
+        save_config()
+        await message.answer(f"✅ @{channel} добавлен ({len(SOURCE_CHANNELS)} источников)")
+    except Exception as e:
+        await message.answer(f"❌ @{channel}: {str(e)[:100]}")
+
+
+@dp.message(Command("remove_source"))
+async def remove_source_handler(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer("Использование: /remove_source channel_name")
+        return
+    
+    channel = args[1].strip().replace("@", "")
+    if remove_source(channel):
+        save_config()
+        await message.answer(f"🗑 @{channel} удалён ({len(SOURCE_CHANNELS)} источников)")
+    else:
+        await message.answer("Не найден")
+
+
+@dp.message(Command("set"))
+async def set_handler(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
     
-    entities_info = f"IDs: {registered_entities[:5]}{'...' if len(registered_entities) > 5 else ''}\n" if registered_entities else "None\n"
+    args = message.text.split(maxsplit=2)
+    if len(args) < 3:
+        await message.answer(f"Использование: /set KEY value\n\n{', '.join(TUNABLES)}, AD_KEYWORDS")
+        return
     
-    me = await userbot.get_me()
-    channel_id = await get_target_channel()
+    key, value = args[1].upper(), args[2].strip()
+    try:
+        if key == "AD_KEYWORDS":
+            AD_KEYWORDS[:] = parse_names(key, [kw for kw in value.split(",") if kw.strip()])
+            compile_ad_pattern()
+        elif key in TUNABLES:
+            set_tunable(key, value)
+        else:
+            await message.answer("Неизвестный ключ")
+            return
+    except ValueError as e:
+        await message.answer(f"❌ {e}")
+        return
     
-    text = f"""🔧 Debug info
+    save_config()
+    logger.info(f"Config: {key} set to {value}")
+    await message.answer(f"✅ {key} = {globals()[key] if key in TUNABLES else len(AD_KEYWORDS)}")
 
-👤 Userbot: @{me.username} (id={me.id})
-📡 Connected: {userbot.is_connected()}
-📢 Target: {channel_id}
 
-{handler_info}
-📋 Registered: {len(registered_entities)} channels
-{entities_info}
-📊 Pending: {len(pending_posts)}
-📅 Scheduled: {len(scheduled_posts)}"""
+@dp.message(Command("profile"))
+async def profile_handler(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
     
-    await message.answer(text)
+    args = message.text.split()[1:]
+    action = args[0] if args else ""
+    
+    if action == "start":
+        if profiler["thread"]:
+            await message.answer("📈 Профилирование уже идёт")
+            return
+        try:
+            seconds = min(int(args[1]), PROFILE_MAX_SECONDS) if len(args) > 1 else PROFILE_DEFAULT_SECONDS
+        except ValueError:
+            seconds = PROFILE_DEFAULT_SECONDS
+        start_profiler()
+        profiler["task"] = asyncio.create_task(finish_profile(seconds))
+        logger.info(f"Profile started for {seconds}s")
+        await message.answer(f"📈 Профилирование {seconds}с...")
+    elif action == "stop":
+        if not profiler["thread"]:
+            await message.answer("Профилирование не запущено")
+            return
+        if profiler["task"]:
+            profiler["task"].cancel()
+        await finish_profile()
+    else:
+        await message.answer("Использование: /profile start [секунды] | /profile stop")
 
 
 @dp.message(Command("fetch"))
@@ -708,36 +1958,120 @@ async def fetch_handler(message: types.Message):
             await message.answer("Последний пост пустой")
             return
         
-        rewritten = await rewrite_text(text) if text else ""
+        if LAZY_REWRITE:
+            rewritten = original_to_html(text) if text else ""
+        else:
+            rewritten = await rewrite_text(text) if text else ""
         post_id = f"fetch_{int(datetime.now().timestamp())}"
         
-        post_data = {
-            "text": rewritten,
-            "original": text,
-            "source": channel,
-            "media_path": None,
-            "media_type": None,
-            "media_group": None
-        }
+        post_data = Post(
+            text=rewritten,
+            original=text,
+            source=channel,
+            rewritten=not LAZY_REWRITE or not text
+        )
         
         if isinstance(msg.media, MessageMediaPhoto):
-            path = await msg.download_media(file=f"/tmp/{post_id}.jpg")
-            post_data["media_path"] = path
-            post_data["media_type"] = "photo"
+            path = await msg.download_media(file=f"{MEDIA_DIR}/{post_id}.jpg")
+            post_data.media_path = path
+            post_data.media_type = "photo"
         elif isinstance(msg.media, MessageMediaDocument):
             mime = msg.file.mime_type or ""
             if mime.startswith("video"):
-                path = await msg.download_media(file=f"/tmp/{post_id}.mp4")
-                post_data["media_path"] = path
-                post_data["media_type"] = "video"
+                path = await msg.download_media(file=f"{MEDIA_DIR}/{post_id}.mp4")
+                post_data.media_path = path
+                post_data.media_type = "video"
         
-        pending_posts[post_id] = post_data
+        add_pending(post_id, post_data)
         await send_preview_to_admin(post_data, post_id)
         
     except Exception as e:
         await message.answer(f"Ошибка: {e}")
 
 
+@dp.message(Command("publish_all"))
+async def publish_all_handler(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    global publish_all_running
+    if publish_all_running:
+        await message.answer("⏳ Публикация уже идёт")
+        return
+    
+    post_ids = list(pending_posts.keys())
+    if not post_ids:
+        await message.answer("Очередь пуста")
+        return
+    
+    publish_all_running = True
+    total = len(post_ids)
+    progress = {"done": 0, "failed": 0, "last_edit": 0.0}
+    published_ids = []
+    status = await message.answer(f"📤 Публикация по очереди: 0/{total}")
+    
+    posts = [(pid, pending_posts.pop(pid)) for pid in post_ids if pid in pending_posts]
+    for uid, epid in list(edit_state.items()):
+        if epid in post_ids:
+            del edit_state[uid]
+    
+    async def update_status(final: bool = False):
+        now = asyncio.get_running_loop().time()
+        if not final and now - progress["last_edit"] < 1:
+            return
+        progress["last_edit"] = now
+        text = f"📤 Публикация по очереди: {progress['done'] + progress['failed']}/{total}\n✅ {progress['done']} | ❌ {progress['failed']}"
+        if final:
+            text = f"📤 Готово: {total}\n✅ {progress['done']} | ❌ {progress['failed']}"
+            targets = {}
+            for pid in published_ids:
+                for chat, ids in published_posts.get(pid, {}).get("targets", {}).items():
+                    targets.setdefault(chat, []).extend(ids)
+            for chat, ids in targets.items():
+                text += f"\n📌 {chat}: #{min(ids)}–#{max(ids)}" if ids else ""
+        try:
+            await status.edit_text(text)
+        except:
+            pass
+    
+    prepare_slots = asyncio.Semaphore(PUBLISH_WORKERS)
+    
+    async def prepare(pid: str, post: Post):
+        async with prepare_slots:
+            if LAZY_REWRITE:
+                await ensure_rewritten(post, pid)
+    
+    remaining = dict(posts)
+    prepared = [asyncio.create_task(prepare(pid, post)) for pid, post in posts]
+    try:
+        for (pid, post), ready in zip(posts, prepared):
+            try:
+                await ready
+                ok = await publish_post(post, pid)
+            except Exception as e:
+                logger.error(f"Publish all error: {e}")
+                ok = False
+            del remaining[pid]
+            if ok:
+                progress["done"] += 1
+                published_ids.append(pid)
+                if not pid.startswith("test_"):
+                    train_relevance(post, "published")
+                await clear_preview_keyboard(post)
+            else:
+                pending_posts[pid] = post
+                progress["failed"] += 1
+            await update_status()
+    finally:
+        for task in prepared:
+            task.cancel()
+        pending_posts.update(remaining)
+        publish_all_running = False
+    
+    await update_status(final=True)
+    logger.info(f"Publish all: {progress['done']} published, {progress['failed']} failed")
+
+
 @dp.callback_query(lambda c: c.data.startswith("pub:"))
 async def publish_callback(callback: types.CallbackQuery):
     post_id = callback.data.split(":", 1)[1]
@@ -755,6 +2089,8 @@ async def publish_callback(callback: types.CallbackQuery):
             del edit_state[uid]
     try:
         if await publish_post(post, found_id):
+            if not found_id.startswith("test_"):
+                train_relevance(post, "published")
             try:
                 await callback.message.edit_reply_markup(reply_markup=None)
             except:
@@ -784,7 +2120,11 @@ async def delay_callback(callback: types.CallbackQuery):
     post = pending_posts.pop(found_id)
     publish_time = datetime.now() + timedelta(hours=1)
     scheduled_posts[found_id] = (publish_time, post)
-    inc_stat("delayed", post.get("source"))
+    if LAZY_REWRITE:
+        spawn(ensure_rewritten(post, found_id))
+    inc_stat("delayed", post.source)
+    if not found_id.startswith("test_"):
+        train_relevance(post, "published")
     for uid, pid in list(edit_state.items()):
         if pid == found_id:
             del edit_state[uid]
@@ -806,7 +2146,9 @@ async def skip_callback(callback: types.CallbackQuery):
             break
     if found_id and found_id in pending_posts:
         post = pending_posts.pop(found_id)
-        inc_stat("skipped", post.get("source"))
+        inc_stat("skipped", post.source)
+        if not found_id.startswith("test_"):
+            train_relevance(post, "skipped")
         for uid, pid in list(edit_state.items()):
             if pid == found_id:
                 del edit_state[uid]
@@ -838,13 +2180,36 @@ async def edit_callback(callback: types.CallbackQuery):
     await callback.answer()
 
 
+@dp.callback_query(lambda c: c.data.startswith("rw:"))
+async def rewrite_callback(callback: types.CallbackQuery):
+    post_id = callback.data.split(":", 1)[1]
+    found_id = None
+    for pid in pending_posts:
+        if pid.startswith(post_id) or post_id.startswith(pid[:50]):
+            found_id = pid
+            break
+    if not found_id:
+        await callback.answer("Не найден")
+        return
+    await callback.answer("✨")
+    post = pending_posts[found_id]
+    await ensure_rewritten(post, found_id)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=None)
+    except:
+        pass
+    if found_id in pending_posts:
+        await send_preview_to_admin(post, found_id)
+
+
 @dp.message(lambda m: m.from_user.id in edit_state and m.text and not m.text.startswith("/"))
 async def handle_edit_text(message: types.Message):
     post_id = edit_state.pop(message.from_user.id)
     if post_id not in pending_posts:
         await message.reply("Не актуален")
         return
-    pending_posts[post_id]["text"] = message.text
+    pending_posts[post_id].text = message.text
+    pending_posts[post_id].rewritten = True
     await message.reply("✅ Текст обновлён")
     await send_preview_to_admin(pending_posts[post_id], post_id)
 
@@ -864,9 +2229,13 @@ async def cleanup_cache():
             deleted_files = 0
             deleted_bytes = 0
             
-            for f in os.listdir("/tmp"):
+            old_pending = expire_pending(now.timestamp())
+            keep = referenced_media()
+            for f in os.listdir(MEDIA_DIR):
                 if f.endswith((".jpg", ".mp4", ".gif", ".png", ".webp")):
-                    path = f"/tmp/{f}"
+                    path = os.path.join(MEDIA_DIR, f)
+                    if path in keep:
+                        continue
                     try:
                         size = os.path.getsize(path)
                         os.remove(path)
@@ -875,30 +2244,6 @@ async def cleanup_cache():
                     except:
                         pass
             
-            old_pending = []
-            for pid in list(pending_posts.keys()):
-                try:
-                    ts = int(pid.split("_")[-1]) if "_" in pid else 0
-                    if ts and (now.timestamp() - ts) > 86400:
-                        old_pending.append(pid)
-                except:
-                    pass
-            
-            for pid in old_pending:
-                post = pending_posts.pop(pid, None)
-                if post:
-                    if post.get("media_path"):
-                        try:
-                            os.remove(post["media_path"])
-                        except:
-                            pass
-                    if post.get("media_group"):
-                        for m in post["media_group"]:
-                            try:
-                                os.remove(m["path"])
-                            except:
-                                pass
-            
             old_scheduled = []
             for pid, (pt, _) in list(scheduled_posts.items()):
                 if (now - pt).total_seconds() > 86400:
@@ -909,39 +2254,130 @@ async def cleanup_cache():
             
             media_groups.clear()
             recent_hashes.clear()
+            recent_media_ids.clear()
+            recent_media_hashes.clear()
             
             mb = deleted_bytes / 1024 / 1024
-            logger.info(f"Cleanup: {deleted_files} files ({mb:.1f}MB), {len(old_pending)} old pending, {len(old_scheduled)} old scheduled")
+            logger.info(f"Cleanup: {deleted_files} files ({mb:.1f}MB), {old_pending} old pending, {len(old_scheduled)} old scheduled")
             
             if deleted_files > 0 or old_pending or old_scheduled:
-                await bot.send_message(ADMIN_ID, f"🧹 Очистка:\n• {deleted_files} файлов ({mb:.1f}MB)\n• {len(old_pending)} старых постов\n• {len(old_scheduled)} просроченных")
+                await bot.send_message(ADMIN_ID, f"🧹 Очистка:\n• {deleted_files} файлов ({mb:.1f}MB)\n• {old_pending} старых постов\n• {len(old_scheduled)} просроченных")
         
         except Exception as e:
             logger.error(f"Cleanup error: {e}")
 
 
-async def keepalive():
+def note_update(chat_id: int, source: str, msg_id: int) -> bool:
+    key = (chat_id, msg_id)
+    if key in seen_messages:
+        return False
+    seen_messages.append(key)
+    
+    now = time.time()
+    conn_metrics["last_update"] = now
+    activity = source_activity.get(chat_id)
+    if activity is None:
+        source_activity[chat_id] = {"source": source, "last_seen": now, "last_id": msg_id,
+                                    "interval": None, "count": 1, "checked": 0}
+        return True
+    gap = now - activity["last_seen"]
+    activity["interval"] = gap if activity["interval"] is None else 0.8 * activity["interval"] + 0.2 * gap
+    activity["last_seen"] = now
+    activity["last_id"] = max(activity["last_id"], msg_id)
+    activity["count"] += 1
+    return True
+
+
+async def reconnect_userbot(reason: str):
+    if reconnect_lock.locked():
+        async with reconnect_lock:
+            return
+    async with reconnect_lock:
+        started = time.monotonic()
+        delay = 1
+        conn_metrics["reconnects"] += 1
+        logger.warning(f"RECONNECT: {reason}")
+        while not shutdown_event.is_set():
+            try:
+                if not userbot.is_connected():
+                    await userbot.connect()
+                await userbot.catch_up()
+                conn_metrics["catch_ups"] += 1
+                break
+            except Exception as e:
+                logger.error(f"RECONNECT: failed ({e}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        conn_metrics["last_recovery"] = time.monotonic() - started
+        logger.info(f"RECONNECT: recovered in {conn_metrics['last_recovery']:.1f}s")
+
+
+async def recover_source(chat_id: int):
+    if chat_id not in source_chat_ids:
+        source_activity.pop(chat_id, None)
+        return
+    activity = source_activity[chat_id]
+    msgs = await userbot.get_messages(chat_id, min_id=activity["last_id"], limit=RECOVER_LIMIT)
+    missed = [m for m in reversed(msgs) if m.id > activity["last_id"]]
+    if missed:
+        conn_metrics["recovered"] += len(missed)
+        logger.warning(f"GAP: @{activity['source']} recovered {len(missed)} missed messages")
+    for msg in missed:
+        spawn(process_message(msg, activity["source"], chat_id))
+
+
+async def check_update_gaps():
+    now = time.time()
+    for chat_id, activity in list(source_activity.items()):
+        if activity["interval"] is None or activity["count"] < 3:
+            continue
+        threshold = max(GAP_MIN, GAP_FACTOR * activity["interval"])
+        if now - activity["last_seen"] > threshold and now - activity["checked"] > threshold:
+            activity["checked"] = now
+            conn_metrics["gaps"] += 1
+            try:
+                await recover_source(chat_id)
+            except Exception as e:
+                logger.error(f"GAP: @{activity['source']} check failed: {e}")
+    
+    last_update = conn_metrics["last_update"]
+    if last_update and now - last_update > STREAM_GAP and now - conn_metrics.get("last_catch_up", 0) > STREAM_GAP:
+        conn_metrics["last_catch_up"] = now
+        logger.warning(f"GAP: no updates for {int(now - last_update)}s, running catch_up")
+        await userbot.catch_up()
+        conn_metrics["catch_ups"] += 1
+
+
+async def connection_watchdog():
     while True:
-        await asyncio.sleep(300)
+        await asyncio.sleep(WATCHDOG_INTERVAL)
+        if not userbot.is_connected():
+            await reconnect_userbot("watchdog: disconnected")
+            continue
         try:
-            if userbot.is_connected():
-                await userbot.get_me()
-            else:
-                logger.warning("KEEPALIVE: disconnected, reconnecting...")
-                await userbot.connect()
+            await check_update_gaps()
         except Exception as e:
-            logger.error(f"KEEPALIVE: {e}")
+            logger.error(f"WATCHDOG: {e}")
+
+
+def format_connection() -> str:
+    recovery = conn_metrics["last_recovery"]
+    last_update = conn_metrics["last_update"]
+    since = f"{int(time.time() - last_update)}s" if last_update else "—"
+    return (f"🔌 Reconnects: {conn_metrics['reconnects']} (last {f'{recovery:.1f}s' if recovery is not None else '—'}) | "
+            f"catch_up: {conn_metrics['catch_ups']}\n"
+            f"🕳 Gaps: {conn_metrics['gaps']} | recovered: {conn_metrics['recovered']} | last update: {since} ago")
 
 
 async def run_bot_polling():
     retry_delay = 5
     max_delay = 60
     
-    while True:
+    while not shutdown_event.is_set():
         try:
             logger.info("Starting aiogram polling...")
             retry_delay = 5
-            await dp.start_polling(bot)
+            await dp.start_polling(bot, handle_signals=False)
         except Exception as e:
             logger.error(f"Polling error: {e}")
             logger.info(f"Retrying in {retry_delay}s...")
@@ -949,33 +2385,481 @@ async def run_bot_polling():
             retry_delay = min(retry_delay * 2, max_delay)
 
 
-async def main():
-    load_stats()
-    stats["start_time"] = datetime.now().isoformat()
-    
+def track_task(task: asyncio.Task):
+    tracked_tasks.add(task)
+    task.add_done_callback(tracked_tasks.discard)
+    return task
+
+
+def spawn(coro) -> asyncio.Task:
+    return track_task(asyncio.create_task(coro))
+
+
+async def supervise(name: str, factory):
+    delay = 1
+    while not shutdown_event.is_set():
+        started = time.monotonic()
+        try:
+            await factory()
+            if shutdown_event.is_set():
+                return
+            logger.warning(f"TASK {name}: exited, restarting in {delay}s")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"TASK {name}: crashed: {e}, restarting in {delay}s")
+        task_restarts[name] = task_restarts.get(name, 0) + 1
+        if time.monotonic() - started > 60:
+            delay = 1
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        delay = min(delay * 2, 60)
+
+
+def start_background(name: str, factory):
+    background_tasks[name] = asyncio.create_task(supervise(name, factory), name=name)
+
+
+def format_tasks() -> str:
+    lines = []
+    for name, task in background_tasks.items():
+        state = "✓" if not task.done() else "✗"
+        lines.append(f"{state} {name} (restarts: {task_restarts.get(name, 0)})")
+    lines.append(f"In-flight: {len(tracked_tasks)} (max {MAX_POST_TASKS} posts at once)")
+    return "\n".join(lines)
+
+
+def save_state():
+    state = {
+        "pending": {pid: asdict(post) for pid, post in pending_posts.items()},
+        "scheduled": {pid: [pt.isoformat(), asdict(post)] for pid, (pt, post) in scheduled_posts.items()},
+        "published": published_posts
+    }
+    try:
+        with open(STATE_FILE, 'w') as f:
+            json.dump(state, f)
+        logger.info(f"State saved: {len(pending_posts)} pending, {len(scheduled_posts)} scheduled")
+    except Exception as e:
+        logger.error(f"State save error: {e}")
+
+
+def post_media_exists(post: Post) -> bool:
+    if post.file_ids:
+        return True
+    if post.media_group:
+        return any(os.path.exists(m.path) for m in post.media_group)
+    if post.media_path:
+        return os.path.exists(post.media_path)
+    return True
+
+
+def referenced_media() -> set:
+    paths = set()
+    for post in list(pending_posts.values()) + [p for _, p in scheduled_posts.values()]:
+        if post.media_path:
+            paths.add(post.media_path)
+        paths.update(m.path for m in post.media_group or [])
+    return paths
+
+
+def load_state():
+    try:
+        if not os.path.exists(STATE_FILE):
+            return
+        with open(STATE_FILE, 'r') as f:
+            state = json.load(f)
+        os.remove(STATE_FILE)
+        for pid, data in state.get("pending", {}).items():
+            post = Post.from_dict(data)
+            if post_media_exists(post):
+                pending_posts[pid] = post
+        for pid, (pt, data) in state.get("scheduled", {}).items():
+            post = Post.from_dict(data)
+            if post_media_exists(post):
+                scheduled_posts[pid] = (datetime.fromisoformat(pt), post)
+        published_posts.update(state.get("published", {}))
+        logger.info(f"State restored: {len(pending_posts)} pending, {len(scheduled_posts)} scheduled")
+    except Exception as e:
+        logger.error(f"State load error: {e}")
+
+
+async def graceful_shutdown():
     logger.info("="*50)
-    logger.info("BOT STARTING")
+    logger.info("SHUTTING DOWN")
     logger.info("="*50)
     
-    await userbot.start()
-    logger.info("Userbot client started")
+    userbot.remove_event_handler(handle_new_post)
+    try:
+        await dp.stop_polling()
+    except Exception:
+        pass
     
-    me = await userbot.get_me()
-    logger.info(f"Logged in as: @{me.username} (id={me.id})")
+    in_flight = [t for t in tracked_tasks if not t.done()]
+    if in_flight:
+        logger.info(f"Draining {len(in_flight)} tasks...")
+        _, not_done = await asyncio.wait(in_flight, timeout=SHUTDOWN_TIMEOUT)
+        if not_done:
+            logger.warning(f"{len(not_done)} tasks did not finish in {SHUTDOWN_TIMEOUT}s")
     
-    channel_id = await get_target_channel()
-    logger.info(f"Target channel: {channel_id}")
+    for task in background_tasks.values():
+        task.cancel()
+    await asyncio.gather(*background_tasks.values(), return_exceptions=True)
     
-    await userbot.catch_up()
-    logger.info("catch_up() completed")
+    save_state()
+    save_stats()
+    save_series()
+    save_relevance()
     
-    registered = 0
-    entities = []
-    global registered_entities
+    try:
+        await bot.send_message(ADMIN_ID, f"🔴 Бот остановлен\nСохранено: {len(pending_posts)} в очереди, {len(scheduled_posts)} отложено")
+    except:
+        pass
+    try:
+        await userbot.disconnect()
+    except:
+        pass
+    await bot.session.close()
+
+
+def describe_handle(handle) -> str:
+    callback = handle._callback
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        return getattr(coro, "__qualname__", None) or owner.get_name()
+    return getattr(callback, "__qualname__", None) or repr(callback)[:60]
+
+
+def install_slow_callback_detector():
+    original_run = asyncio.events.Handle._run
     
-    logger.info(f"Registering {len(SOURCE_CHANNELS)} channels...")
+    def timed_run(handle):
+        start = time.perf_counter()
+        original_run(handle)
+        elapsed = time.perf_counter() - start
+        if elapsed >= SLOW_CALLBACK_THRESHOLD:
+            name = describe_handle(handle)
+            entry = slow_callbacks.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            entry["count"] += 1
+            entry["total"] += elapsed
+            entry["max"] = max(entry["max"], elapsed)
+            logger.warning(f"SLOW CALLBACK: {name} blocked loop for {elapsed * 1000:.0f}ms")
     
-    for channel in SOURCE_CHANNELS:
+    asyncio.events.Handle._run = timed_run
+
+
+async def loop_monitor():
+    global loop_lag_max
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_MONITOR_INTERVAL)
+        lag = max(0.0, loop.time() - start - LOOP_MONITOR_INTERVAL)
+        loop_lag_samples.append(lag)
+        loop_lag_max = max(loop_lag_max, lag)
+        if lag >= LOOP_LAG_WARN:
+            logger.warning(f"LOOP LAG: {lag * 1000:.0f}ms")
+
+
+def format_loop_health() -> str:
+    if loop_lag_samples:
+        recent = sorted(loop_lag_samples)
+        avg = sum(recent) / len(recent)
+        p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))]
+        text = f"⏱ Loop lag: avg {avg * 1000:.0f}ms | p95 {p95 * 1000:.0f}ms | max {loop_lag_max * 1000:.0f}ms\n"
+    else:
+        text = "⏱ Loop lag: —\n"
+    top = sorted(slow_callbacks.items(), key=lambda kv: kv[1]["total"], reverse=True)[:5]
+    if top:
+        text += f"🐢 Slow callbacks (>{SLOW_CALLBACK_THRESHOLD * 1000:.0f}ms):\n"
+        for name, entry in top:
+            text += f"• {name}: ×{entry['count']}, max {entry['max'] * 1000:.0f}ms, total {entry['total']:.1f}s\n"
+    return text
+
+
+def sample_stacks(stop: threading.Event, samples: dict, thread_id: int):
+    while not stop.wait(PROFILE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        samples[key] = samples.get(key, 0) + 1
+
+
+def start_profiler():
+    stop = threading.Event()
+    profiler["stop"] = stop
+    profiler["samples"] = {}
+    profiler["started"] = time.monotonic()
+    profiler["thread"] = threading.Thread(
+        target=sample_stacks,
+        args=(stop, profiler["samples"], threading.main_thread().ident),
+        name="profiler",
+        daemon=True
+    )
+    profiler["thread"].start()
+
+
+def stop_profiler(thread: threading.Thread, stop: threading.Event):
+    stop.set()
+    thread.join()
+    return profiler["samples"], time.monotonic() - profiler["started"]
+
+
+def summarize_profile(samples: dict, top: int = 15):
+    total = sum(samples.values()) or 1
+    own = {}
+    inclusive = {}
+    for stack, count in samples.items():
+        frames = stack.split(";")
+        own[frames[-1]] = own.get(frames[-1], 0) + count
+        for name in set(frames):
+            inclusive[name] = inclusive.get(name, 0) + count
+    
+    def fmt(table):
+        rows = sorted(table.items(), key=lambda kv: kv[1], reverse=True)[:top]
+        return "\n".join(f"{count / total * 100:5.1f}% {name}" for name, count in rows)
+    
+    return f"Self:\n{fmt(own)}\n\nInclusive:\n{fmt(inclusive)}"
+
+
+async def finish_profile(delay: float = 0):
+    if delay:
+        await asyncio.sleep(delay)
+    thread = profiler["thread"]
+    if not thread:
+        return
+    profiler["thread"] = None
+    profiler["task"] = None
+    samples, elapsed = await asyncio.to_thread(stop_profiler, thread, profiler["stop"])
+    total = sum(samples.values())
+    summary = summarize_profile(samples)
+    collapsed = "\n".join(f"{stack} {count}" for stack, count in sorted(samples.items(), key=lambda kv: kv[1], reverse=True))
+    report = f"# {total} samples over {elapsed:.1f}s\n\n{summary}\n\n# Collapsed stacks\n{collapsed}\n"
+    filename = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    logger.info(f"Profile finished: {total} samples over {elapsed:.1f}s")
+    try:
+        await bot.send_document(ADMIN_ID, BufferedInputFile(report.encode(), filename=filename),
+                                caption=f"📈 {total} сэмплов за {elapsed:.0f}с")
+        top = summarize_profile(samples, top=8).split("\n\nInclusive:")[0]
+        await bot.send_message(ADMIN_ID, f"<pre>{html.escape(top)}</pre>", parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Profile report error: {e}")
+
+
+def to_peer_id(entity_id: int) -> int:
+    return entity_id if entity_id < 0 else utils.get_peer_id(PeerChannel(entity_id))
+
+
+def load_cached_entities() -> dict:
+    try:
+        if os.path.exists(ENTITIES_FILE):
+            with open(ENTITIES_FILE, 'r') as f:
+                cached = json.load(f)
+            return {c: to_peer_id(cached[c]) for c in SOURCE_CHANNELS if c in cached}
+    except:
+        pass
+    return {}
+
+
+def save_cached_entities(resolved: dict):
+    try:
+        with open(ENTITIES_FILE, 'w') as f:
+            json.dump(resolved, f)
+    except:
+        pass
+
+
+def is_source_event(event) -> bool:
+    return event.chat_id in source_chat_ids
+
+
+def register_source_handler(resolved: dict):
+    global registered_entities, source_handler_registered
+    for channel, peer_id in resolved.items():
+        if channel not in SOURCE_CHANNELS:
+            continue
+        old = resolved_sources.get(channel)
+        resolved_sources[channel] = peer_id
+        if old is not None and old != peer_id and old not in resolved_sources.values():
+            source_chat_ids.discard(old)
+        source_chat_ids.add(peer_id)
+    registered_entities = list(source_chat_ids)
+    if not source_handler_registered:
+        userbot.add_event_handler(
+            handle_new_post,
+            events.NewMessage(func=is_source_event)
+        )
+        source_handler_registered = True
+    logger.info(f"Handler registered for {len(source_chat_ids)} channel IDs")
+
+
+TUNABLES = {
+    "MEDIA_GROUP_TIMEOUT": (float, 1, 300),
+    "MAX_HASHES": (int, 1, None),
+    "MAX_MEDIA_HASHES": (int, 1, None),
+    "MAX_MEDIA_IDS": (int, 1, None),
+    "MEDIA_HASH_DISTANCE": (int, 0, 64),
+    "MAX_PENDING": (int, 1, None),
+    "REWRITE_MODEL": (str, None, None),
+    "REWRITE_MAX_TOKENS": (int, 1, None),
+    "REWRITE_TEMPERATURE": (float, 0, 2),
+    "REWRITE_BATCH_WINDOW": (float, 0, 60),
+    "REWRITE_BATCH_SIZE": (int, 1, 50),
+    "RELEVANCE_THRESHOLD": (float, 0, 1),
+    "RELEVANCE_DROP": (float, 0, 1),
+    "CHAT_SEND_INTERVAL": (float, 0, 60)
+}
+
+
+def parse_tunable(key: str, value):
+    kind, low, high = TUNABLES[key]
+    if isinstance(value, bool) or isinstance(value, (list, dict)):
+        raise ValueError(f"{key}: неверный тип")
+    value = kind(value)
+    if kind is str:
+        value = value.strip()
+        if not value:
+            raise ValueError(f"{key}: пустое значение")
+        return value
+    if low is not None and not value >= low:
+        raise ValueError(f"{key}: минимум {low}")
+    if high is not None and not value <= high:
+        raise ValueError(f"{key}: максимум {high}")
+    return value
+
+
+def parse_names(key: str, value) -> List[str]:
+    if not isinstance(value, list) or not all(isinstance(v, str) and v.strip() for v in value):
+        raise ValueError(f"{key}: нужен список непустых строк")
+    return [v.strip() for v in value]
+
+
+def read_config() -> dict:
+    global config_mtime
+    try:
+        if not os.path.exists(CONFIG_FILE):
+            return {}
+        config_mtime = os.path.getmtime(CONFIG_FILE)
+        with open(CONFIG_FILE, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Config read error: {e}")
+        return {}
+
+
+def save_config():
+    global config_mtime
+    config = {"SOURCE_CHANNELS": SOURCE_CHANNELS, "AD_KEYWORDS": AD_KEYWORDS}
+    config.update({key: globals()[key] for key in TUNABLES})
+    try:
+        with open(CONFIG_FILE, 'w') as f:
+            json.dump(config, f, ensure_ascii=False, indent=2)
+        config_mtime = os.path.getmtime(CONFIG_FILE)
+    except Exception as e:
+        logger.error(f"Config save error: {e}")
+
+
+def set_tunable(key: str, value):
+    globals()[key] = parse_tunable(key, value)
+    if key == "MAX_HASHES":
+        del recent_hashes[:-MAX_HASHES]
+    elif key == "MAX_MEDIA_HASHES":
+        del recent_media_hashes[:-MAX_MEDIA_HASHES]
+    elif key == "MAX_MEDIA_IDS":
+        del recent_media_ids[:-MAX_MEDIA_IDS]
+    elif key == "MAX_PENDING":
+        while len(pending_posts) > MAX_PENDING:
+            evict_pending(min(pending_posts, key=lambda pid: pending_posts[pid].created_at), "queue resized")
+
+
+async def add_source(channel: str) -> bool:
+    if channel in SOURCE_CHANNELS:
+        return True
+    entity = await userbot.get_entity(channel)
+    peer_id = utils.get_peer_id(entity)
+    SOURCE_CHANNELS.append(channel)
+    resolved_sources[channel] = peer_id
+    source_chat_ids.add(peer_id)
+    registered_entities.append(peer_id)
+    save_cached_entities(resolved_sources)
+    logger.info(f"Source added: @{channel} id={peer_id}")
+    return True
+
+
+def remove_source(channel: str) -> bool:
+    if channel not in SOURCE_CHANNELS:
+        return False
+    SOURCE_CHANNELS.remove(channel)
+    peer_id = resolved_sources.pop(channel, None)
+    if peer_id is not None and peer_id not in resolved_sources.values():
+        source_chat_ids.discard(peer_id)
+        source_activity.pop(peer_id, None)
+        if peer_id in registered_entities:
+            registered_entities.remove(peer_id)
+    save_cached_entities(resolved_sources)
+    logger.info(f"Source removed: @{channel}")
+    return True
+
+
+async def apply_config(config: dict, live: bool = True):
+    for key, value in config.items():
+        try:
+            if key == "SOURCE_CHANNELS":
+                value = [c.replace("@", "") for c in parse_names(key, value)]
+                if not live:
+                    SOURCE_CHANNELS[:] = value
+                    continue
+                for channel in [c for c in SOURCE_CHANNELS if c not in value]:
+                    remove_source(channel)
+                for channel in [c for c in value if c not in SOURCE_CHANNELS]:
+                    try:
+                        await add_source(channel)
+                    except Exception as e:
+                        logger.error(f"Config: cannot add @{channel}: {e}")
+            elif key == "AD_KEYWORDS":
+                AD_KEYWORDS[:] = parse_names(key, value)
+                compile_ad_pattern()
+            elif key in TUNABLES:
+                if globals()[key] != parse_tunable(key, value):
+                    set_tunable(key, value)
+                    logger.info(f"Config: {key} = {globals()[key]}")
+            else:
+                logger.warning(f"Config: unknown key {key}")
+        except Exception as e:
+            logger.error(f"Config: bad value for {key}: {e}")
+
+
+async def config_watcher():
+    while True:
+        await asyncio.sleep(CONFIG_POLL_INTERVAL)
+        try:
+            mtime = os.path.getmtime(CONFIG_FILE) if os.path.exists(CONFIG_FILE) else None
+        except OSError:
+            continue
+        if mtime and mtime != config_mtime:
+            logger.info("Config file changed, reloading")
+            await apply_config(read_config())
+
+
+def mark_startup(stage: str):
+    startup_timings[stage] = time.monotonic() - boot_time
+    logger.info(f"Startup: {stage} at {startup_timings[stage]:.1f}s")
+
+
+def format_startup_timings() -> str:
+    if not startup_timings:
+        return "—"
+    return ", ".join(f"{k} {v:.1f}s" for k, v in startup_timings.items())
+
+
+async def verify_channel(channel: str, semaphore: asyncio.Semaphore):
+    async with semaphore:
         try:
             entity = await userbot.get_entity(channel)
             msgs = await userbot.get_messages(entity, limit=1)
@@ -986,47 +2870,109 @@ async def main():
                 last_post = f" (last: {hours}h ago)"
             
             logger.info(f"  ✓ @{channel} id={entity.id}{last_post}")
-            entities.append(entity.id)
-            registered += 1
+            return utils.get_peer_id(entity)
         except Exception as e:
             logger.error(f"  ✗ @{channel}: {e}")
+            return None
+
+
+async def finish_startup():
+    try:
+        me = await userbot.get_me()
+        logger.info(f"Logged in as: @{me.username} (id={me.id})")
+        
+        channel_id = await get_target_channel()
+        logger.info(f"Target channel: {channel_id}")
+        
+        logger.info(f"Verifying {len(SOURCE_CHANNELS)} channels...")
+        
+        semaphore = asyncio.Semaphore(STARTUP_CONCURRENCY)
+        ids = await asyncio.gather(*[verify_channel(c, semaphore) for c in SOURCE_CHANNELS])
+        resolved = {c: eid for c, eid in zip(SOURCE_CHANNELS, ids) if eid}
+        entities = list(resolved.values())
+        
+        logger.info(f"Registered {len(entities)}/{len(SOURCE_CHANNELS)} channels")
+        
+        if entities:
+            added = not source_chat_ids.issuperset(entities)
+            register_source_handler(resolved)
+            if added:
+                mark_startup("handler")
+        if resolved:
+            save_cached_entities(resolved_sources)
+        mark_startup("channels_verified")
+        
+        await userbot.catch_up()
+        mark_startup("catch_up")
+        
+        logger.info("="*50)
+        logger.info("BOT READY")
+        logger.info("="*50)
+        
+        try:
+            await bot.send_message(ADMIN_ID, f"🟢 Бот запущен\nКаналов: {len(entities)}/{len(SOURCE_CHANNELS)}\nTarget: {channel_id}\n⏱ {format_startup_timings()}")
+        except:
+            pass
+    except Exception as e:
+        logger.error(f"Startup verification error: {e}")
+
+
+async def run_userbot():
+    while not shutdown_event.is_set():
+        try:
+            await userbot.run_until_disconnected()
+        except Exception as e:
+            logger.error(f"Userbot disconnected: {e}")
+        if shutdown_event.is_set():
+            return
+        await reconnect_userbot("disconnected")
+
+
+async def main():
+    global boot_time
+    boot_time = time.monotonic()
+    install_slow_callback_detector()
     
-    logger.info(f"Registered {registered}/{len(SOURCE_CHANNELS)} channels")
-    
-    if entities:
-        registered_entities = entities
-        userbot.add_event_handler(
-            handle_new_post,
-            events.NewMessage(chats=entities)
-        )
-        logger.info(f"Handler registered for {len(entities)} channel IDs")
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, shutdown_event.set)
+        except NotImplementedError:
+            pass
     
-    asyncio.create_task(run_bot_polling())
-    asyncio.create_task(scheduled_publisher())
-    asyncio.create_task(keepalive())
-    asyncio.create_task(cleanup_cache())
+    start_background("loop_monitor", loop_monitor)
+    load_stats()
+    load_relevance()
+    load_state()
+    await apply_config(read_config(), live=False)
+    compile_ad_pattern()
+    stats["start_time"] = datetime.now().isoformat()
     
     logger.info("="*50)
-    logger.info("BOT READY")
+    logger.info("BOT STARTING")
     logger.info("="*50)
     
-    try:
-        await bot.send_message(ADMIN_ID, f"🟢 Бот запущен\nКаналов: {registered}/{len(SOURCE_CHANNELS)}\nTarget: {channel_id}")
-    except:
-        pass
+    start_background("polling", run_bot_polling)
+    mark_startup("polling")
     
-    while True:
-        try:
-            await userbot.run_until_disconnected()
-        except Exception as e:
-            logger.error(f"Userbot disconnected: {e}")
-            await asyncio.sleep(5)
-            try:
-                if not userbot.is_connected():
-                    await userbot.connect()
-                    logger.info("Userbot reconnected!")
-            except Exception as re:
-                logger.error(f"Reconnect failed: {re}")
+    await userbot.start()
+    logger.info("Userbot client started")
+    
+    cached = load_cached_entities()
+    if cached:
+        register_source_handler(cached)
+        mark_startup("handler_cached")
+    
+    start_background("scheduler", scheduled_publisher)
+    start_background("watchdog", connection_watchdog)
+    start_background("cleanup", cleanup_cache)
+    start_background("series", series_saver)
+    start_background("config", config_watcher)
+    start_background("userbot", run_userbot)
+    spawn(finish_startup())
+    
+    await shutdown_event.wait()
+    await graceful_shutdown()
 
 
 if __name__ == "__main__":